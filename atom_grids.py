@@ -69,16 +69,11 @@ def write_grid_to_dx_file(dx_file, grid, center, resolution):
         f.write('delta 0 0 {:.5f}\n'.format(resolution))
         f.write('object 2 class gridconnections counts {:d} {:d} {:d}\n'.format(dim, dim, dim))
         f.write('object 3 class array type double rank 0 items [ {:d} ] data follows\n'.format(dim**3))
-        total = 0
-        for i in range(dim):
-            for j in range(dim):
-                for k in range(dim):
-                    f.write('{:.10f}'.format(grid[i][j][k]))
-                    total += 1
-                    if total % 3 == 0:
-                        f.write('\n')
-                    else:
-                        f.write(' ')
+        # three values per line, in C order, formatted in a single call
+        values = np.asarray(grid).ravel().tolist()
+        n_lines, n_rem = divmod(len(values), 3)
+        f.write(('{:.10f} {:.10f} {:.10f}\n' * n_lines).format(*values[:3*n_lines]))
+        f.write(('{:.10f} ' * n_rem).format(*values[3*n_lines:]))
 
 
 def write_grids_to_dx_files(out_prefix, grids, channels, center, resolution):
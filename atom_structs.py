@@ -1,6 +1,7 @@
-import os, struct
+import os, gzip
 import numpy as np
 
+import atom_types
 import molecules
 
 
@@ -18,7 +19,7 @@ class AtomStruct(object):
             raise ValueError('first dim of AtomStruct xyz and c must be equal')
         if xyz.shape[1] != 3:
             raise ValueError('second dim of AtomStruct xyz must be 3')
-        if any(c < 0) or any(c >= len(channels)):
+        if np.any(c < 0) or np.any(c >= len(channels)):
             raise ValueError('invalid channel index in AtomStruct c')
 
         self.xyz = xyz
@@ -34,7 +35,9 @@ class AtomStruct(object):
 
         if self.n_atoms > 0:
             self.center = self.xyz.mean(0)
-            self.radius = max(np.linalg.norm(self.xyz - self.center, axis=1))
+            # max distance from center, taking one sqrt of the max squared distance
+            diff = self.xyz - self.center
+            self.radius = np.sqrt(np.einsum('ij,ij->i', diff, diff).max())
         else:
             self.center = np.full(3, np.nan)
             self.radius = np.nan
@@ -98,20 +101,25 @@ class AtomStruct(object):
         self.bonds = (atom_dist2 < max_bond_dist2 + tol)
 
 
+# gninatypes files are packed (x, y, z, smina type) records
+gninatypes_dtype = np.dtype([
+    ('xyz', 'f4', 3), ('t', 'i4')
+])
+
+
 def read_gninatypes_file(gtypes_file, channels):
     channel_names = [c.name for c in channels]
-    channel_name_idx = {n: i for i, n in enumerate(channel_names)}
-    xyz, c = [], []
-    with open(gtypes_file, 'rb') as f:
-        atom_bytes = f.read(16)
-        while atom_bytes:
-            x, y, z, t = struct.unpack('fffi', atom_bytes)
-            smina_type = atom_types.smina_types[t]
-            channel_name = 'Ligand' + smina_type.name
-            if channel_name in channel_name_idx:
-                c_ = channel_names.index(channel_name)
-                xyz.append([x, y, z])
-                c.append(c_)
-            atom_bytes = f.read(16)
-    assert xyz and c, lig_file
-    return np.array(xyz), np.array(c)
+
+    # map each smina type to its ligand channel index, or -1
+    smina_to_channel = np.full(len(atom_types.smina_types), -1, dtype=int)
+    for t, smina_type in enumerate(atom_types.smina_types):
+        channel_name = 'Ligand' + smina_type.name
+        if channel_name in channel_names:
+            smina_to_channel[t] = channel_names.index(channel_name)
+
+    atoms = np.fromfile(gtypes_file, dtype=gninatypes_dtype)
+    c = smina_to_channel[atoms['t']]
+    keep = c >= 0
+    xyz, c = atoms['xyz'][keep].astype(float), c[keep]
+    assert len(xyz) > 0, gtypes_file
+    return xyz, c
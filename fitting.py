@@ -11,7 +11,6 @@ from rdkit import Geometry
 from skimage.segmentation import flood_fill
 from collections import namedtuple
 from scipy.spatial.distance import pdist
-from scipy.spatial.distance import squareform
 import pickle
 
 from atom_structs import AtomStruct
@@ -24,15 +23,16 @@ def grid_to_xyz(gcoords, mgrid):
 def select_atom_starts(mgrid, G, radius):
     '''Given a single channel grid and the atomic radius for that type,
     select initial positions using a weight random selection that treats 
-    each disconnected volume of density separately'''
+    each disconnected volume of density separately.  Returns an (n,3) array'''
     per_atom_volume = radius**3*((2*np.pi)**1.5) 
 
-    mask = G.cpu().numpy().copy()
+    #copy the grid off the device once and reuse it for every region
+    values = G.cpu().numpy()
+    mask = values.copy()
 
     #look for islands of density greater than 0.5 (todo: parameterize this threshold?)
     #label each island in mask
     THRESHOLD = 0.5
-    values = G.cpu().numpy()
     mask[values >= THRESHOLD] = 1.0
     mask[values < THRESHOLD] = 0
 
@@ -50,10 +50,11 @@ def select_atom_starts(mgrid, G, radius):
     retcoords = []
 
     #print("#masks",len(masks))
+    flatvalues = values.ravel()
     for M in masks:
-        maskedG = G.cpu().numpy()
-        maskedG[~M] = 0
-        flatG = maskedG.flatten()
+        #only touch the voxels of this region, not the whole grid
+        regionidx = np.flatnonzero(M)
+        flatG = flatvalues[regionidx] #fancy indexing copies, so values is not modified
         total = float(flatG.sum())
 
         if total < .1*per_atom_volume:
@@ -64,14 +65,16 @@ def select_atom_starts(mgrid, G, radius):
             continue
 
         flatG[flatG > 1.0] = 1.0
-        rand = np.random.choice(range(len(flatG)), cnt, False, flatG/flatG.sum())
+        rand = np.random.choice(regionidx, cnt, False, flatG/flatG.sum())
         gcoords = np.array(np.unravel_index(rand,G.shape)).T
         ccoords = grid_to_xyz(gcoords, mgrid)
 
-        retcoords += list(ccoords)
+        retcoords.append(ccoords)
 
     #print("coords",len(retcoords))
-    return retcoords
+    if not retcoords:
+        return np.zeros((0,3))
+    return np.concatenate(retcoords)
 
 
 def simple_atom_fit(mgrid, types,iters=10,tol=0.01,device='cuda',grm=-1.5):
@@ -82,32 +85,25 @@ def simple_atom_fit(mgrid, types,iters=10,tol=0.01,device='cuda',grm=-1.5):
     t_start = time.time()
     #for every channel, select some coordinates and setup the type/radius vectors
     initcoords = []
-    typevecs = []
-    radii = []
-    typeindices = []
-    numatoms = 0
+    n_channels = len(mgrid.channels)
+    counts = np.zeros(n_channels, dtype=int)
     tcnts = {}
-    values = torch.tensor(mgrid.values,device=device)
+    values = torch.tensor(mgrid.values,dtype=torch.float32,device=device)
 
     for (t,G) in enumerate(values):
         ch = mgrid.channels[t]
         coords = select_atom_starts(mgrid, G, ch.atomic_radius)
-        if coords:
-            tvec = np.zeros(len(mgrid.channels))
-            tvec[t] = 1.0
-            tcnt = len(coords)
-            numatoms += tcnt
-
-            r = mgrid.channels[t].atomic_radius
-            initcoords += coords
-            typevecs += [tvec]*tcnt
-            typeindices += [t]*tcnt
-            radii += [r]*tcnt
-            tcnts[t] = tcnt
-
-    typevecs = np.array(typevecs)
-    initcoords = np.array(initcoords)
-    typeindices = np.array(typeindices)
+        if len(coords):
+            initcoords.append(coords)
+            counts[t] = len(coords)
+            tcnts[t] = len(coords)
+
+    #expand per-channel type info to per-atom arrays
+    numatoms = int(counts.sum())
+    typeindices = np.repeat(np.arange(n_channels), counts)
+    typevecs = np.eye(n_channels)[typeindices]
+    radii = np.array([ch.atomic_radius for ch in mgrid.channels])[typeindices]
+    initcoords = np.concatenate(initcoords) if initcoords else np.zeros((0,3))
     #print('typeindices',typeindices)
     #setup gridder
     center = tuple([float(c) for c in mgrid.center])
@@ -156,22 +152,21 @@ def simple_atom_fit(mgrid, types,iters=10,tol=0.01,device='cuda',grm=-1.5):
             break;
         #otherwise, try different starting coordinates for only those
         #atom types that have errors
-        goodcoords = True
         with torch.no_grad():
-            offset = 0
             agrid = gridder.forward(coords,types,radii)     
-            t = 0
-            while offset < len(typeindices):
-                t = typeindices[offset]
-                #eval max error - mse will downplay a single atom of many being off
-                maxerr = float(torch.square(agrid[t]-values[t]).max())
-                if maxerr > tol:
-                    goodcoords = False
-                    ch = mgrid.channels[t]
-                    newcoords = select_atom_starts(mgrid, values[t], ch.atomic_radius)
-                    for (i,coord) in enumerate(newcoords):
-                        coords[i+offset] = torch.tensor(coord,dtype=torch.float)
-                offset += tcnts[t]
+            #eval max error - mse will downplay a single atom of many being off
+            #(for all channels at once, with a single transfer off the device)
+            maxerrs = torch.square(agrid-values).flatten(1).max(dim=1)[0].cpu().numpy()
+            #only visit the channels that have atoms and errors, starting at their first atom
+            offsets = np.cumsum(counts) - counts
+            badtypes = np.flatnonzero((counts > 0) & (maxerrs > tol))
+            goodcoords = len(badtypes) == 0
+            for t in badtypes:
+                offset = offsets[t]
+                ch = mgrid.channels[t]
+                newcoords = select_atom_starts(mgrid, values[t], ch.atomic_radius)
+                for (i,coord) in enumerate(newcoords):
+                    coords[i+offset] = torch.tensor(coord,dtype=torch.float)
         if goodcoords:
             break
     bestagrid = agrid.clone()
@@ -186,7 +181,8 @@ def simple_atom_fit(mgrid, types,iters=10,tol=0.01,device='cuda',grm=-1.5):
         t = 0
         while offset < len(typeindices):
             t = typeindices[offset]
-            maxerr = float(torch.square(agrid[t]-values[t]).max())
+            diff = agrid[t]-values[t] #kept current with agrid below
+            maxerr = float(torch.square(diff).max())
             #print('maxerr',maxerr)
             per_atom_volume = float(radii[offset])**3*((2*np.pi)**1.5) 
             while maxerr > tol:
@@ -194,20 +190,17 @@ def simple_atom_fit(mgrid, types,iters=10,tol=0.01,device='cuda',grm=-1.5):
                 #and move it to the location with too little density
                 tcoords = coords[offset:offset+tcnts[t]].detach().cpu().numpy() #coordinates for this type
 
-                diff = agrid[t]-values[t]
-                possum = float(diff[diff>0].sum())
-                negsum = float(diff[diff <0].sum())
                 maxdiff = float(diff.max())
                 mindiff = float(diff.min())
-                missing_density = -(negsum+possum)
+                missing_density = -float(diff.sum()) #-(negsum+possum)
                 #print('Type %d numcoords %d maxdiff %.5f mindiff %.5f missing %.5f'%(t,len(tcoords),maxdiff,mindiff,missing_density))
                 if missing_density > .25*per_atom_volume: #add atom  MAGIC NUMBER ALERT
                     #needs to be enough total missing density to be close to a whole atom,
                     #but the missing density also needs to be somewhat concentrated
                     #print("Missing density - not enough atoms?")
                     numfixes += 1
-                    minpos = int((agrid[t]-values[t]).argmin())
-                    minpos = grid_to_xyz(np.unravel_index(minpos,agrid[t].shape),mgrid)
+                    minpos = int(diff.argmin())
+                    minpos = grid_to_xyz(np.unravel_index(minpos,diff.shape),mgrid)
                     #add atom: change coords, types, radii, typeindices and tcnts, numatoms
                     numatoms += 1
                     typeindices = np.insert(typeindices, offset, t)
@@ -228,10 +221,10 @@ def simple_atom_fit(mgrid, types,iters=10,tol=0.01,device='cuda',grm=-1.5):
                     #todo, remove atom
                 else:   #move an atom
                     numfixes += 1
-                    maxpos = int((agrid[t]-values[t]).argmax())
-                    minpos = int((agrid[t]-values[t]).argmin())
-                    maxpos = grid_to_xyz(np.unravel_index(maxpos,agrid[t].shape),mgrid)
-                    minpos = grid_to_xyz(np.unravel_index(minpos,agrid[t].shape),mgrid)
+                    maxpos = int(diff.argmax())
+                    minpos = int(diff.argmin())
+                    maxpos = grid_to_xyz(np.unravel_index(maxpos,diff.shape),mgrid)
+                    minpos = grid_to_xyz(np.unravel_index(minpos,diff.shape),mgrid)
 
                     dists = np.square(tcoords - maxpos).sum(axis=1)
                     closesti = np.argmin(dists)
@@ -246,7 +239,8 @@ def simple_atom_fit(mgrid, types,iters=10,tol=0.01,device='cuda',grm=-1.5):
                 agrid = gridder.forward(coords,types,radii) #recompute grid
 
                 #if maxerr hasn't improved, give up
-                newerr = float(torch.square(agrid[t]-values[t]).max())
+                diff = agrid[t]-values[t]
+                newerr = float(torch.square(diff).max())
                 #print(t,'newerr',newerr,'maxerr',maxerr,'maxdiff',maxdiff,'mindiff',mindiff,'missing',missing_density)
                 if newerr >= maxerr:
                     #don't give up if there's still a lot left to fit
@@ -277,18 +271,28 @@ def simple_atom_fit(mgrid, types,iters=10,tol=0.01,device='cuda',grm=-1.5):
     return mol,bestagrid
 
 
+def get_channel_flags(struct, *substrs):
+    '''Return a per-atom boolean array for each substr that is true
+    where the name of the atom's channel contains it.  Names are only
+    checked once per channel, not once per atom.'''
+    c = np.asarray(struct.c, dtype=int)
+    return [np.array([s in ch.name for ch in struct.channels], dtype=bool)[c] for s in substrs]
+
+
 def fixup(atoms, mol, struct):
     '''Set atom properties to match channel.  Keep doing this
     to beat openbabel over the head with what we want to happen.'''
 
+    aromatic, donor, acceptor, nitrogen, oxygen = get_channel_flags(
+        struct, 'Aromatic', 'Donor', 'Acceptor', 'Nitrogen', 'Oxygen')
+
     mol.SetAromaticPerceived(True)  #avoid perception
-    for atom,t in zip(atoms,struct.c):
-        ch = struct.channels[t]
-        if 'Aromatic' in ch.name:
+    for i,atom in enumerate(atoms):
+        if aromatic[i]:
             atom.SetAromatic(True)
             atom.SetHyb(2)
 
-        if 'Donor' in ch.name:
+        if donor[i]:
             if atom.GetExplicitDegree() == atom.GetHvyDegree():
                 if atom.GetHvyDegree() == 1 and atom.GetAtomicNum() == 7:
                     atom.SetImplicitHCount(2)
@@ -296,10 +300,10 @@ def fixup(atoms, mol, struct):
                     atom.SetImplicitHCount(1) 
 
 
-        elif 'Acceptor' in ch.name: # NOT AcceptorDonor because of else
+        elif acceptor[i]: # NOT AcceptorDonor because of else
             atom.SetImplicitHCount(0)   
 
-        if ('Nitrogen' in ch.name or 'Oxygen' in ch.name) and atom.IsInRing(): 
+        if (nitrogen[i] or oxygen[i]) and atom.IsInRing(): 
             #this is a little iffy, ommitting until there is more evidence it is a net positive
             #we don't have aromatic types for nitrogen, but if it
             #is in a ring with aromatic carbon mark it aromatic as well
@@ -365,20 +369,22 @@ def connect_the_dots(mol, atoms, struct, maxbond=4):
 
     #just going to to do n^2 comparisons, can worry about efficiency later
     coords = np.array([(a.GetX(),a.GetY(),a.GetZ()) for a in atoms])
-    dists = squareform(pdist(coords))
-    types = [struct.channels[t].name for t in struct.c]
-
-    for (i,a) in enumerate(atoms):
-        for (j,b) in enumerate(atoms):
-            if a == b:
-                break
-            if dists[i,j] < 0.01:  #reduce from 0.4
-                continue #don't bond too close atoms
-            if dists[i,j] < maxbond:
-                flag = 0
-                if 'Aromatic' in types[i] and 'Aromatic' in types[j]:
-                    flag = ob.OB_AROMATIC_BOND
-                mol.AddBond(a.GetIdx(),b.GetIdx(),1,flag)
+    aromatic, donor = get_channel_flags(struct, 'Aromatic', 'Donor')
+
+    #candidate pairs j < i, in the same order as a nested loop over atoms,
+    #looked up in the condensed distance vector instead of a square matrix
+    n_atoms = len(atoms)
+    pair_i, pair_j = np.tril_indices(n_atoms, k=-1)
+    pair_dists = pdist(coords)[
+        n_atoms*pair_j - pair_j*(pair_j+1)//2 + pair_i - pair_j - 1
+    ]
+    pair_mask = pair_dists >= 0.01 #don't bond too close atoms (reduce from 0.4)
+    pair_mask &= pair_dists < maxbond
+    for i, j in zip(pair_i[pair_mask], pair_j[pair_mask]):
+        flag = 0
+        if aromatic[i] and aromatic[j]:
+            flag = ob.OB_AROMATIC_BOND
+        mol.AddBond(atoms[i].GetIdx(),atoms[j].GetIdx(),1,flag)
 
     atom_maxb = {}
     for (i,a) in enumerate(atoms):
@@ -386,7 +392,7 @@ def connect_the_dots(mol, atoms, struct, maxbond=4):
         #since we want the molecule to be valid for both (rdkit is usually lower)
         maxb = ob.GetMaxBonds(a.GetAtomicNum())
         maxb = min(maxb,pt.GetDefaultValence(a.GetAtomicNum())) 
-        if 'Donor' in types[i]:
+        if donor[i]:
             maxb -= 1 #leave room for hydrogen
         atom_maxb[a.GetIdx()] = maxb
 
@@ -4,17 +4,23 @@ import datetime as dt
 import numpy as np
 import pandas as pd
 import scipy as sp
+import scipy.fft
+import scipy.spatial
 from collections import defaultdict, Counter
 import threading
 import contextlib
+from concurrent.futures import ThreadPoolExecutor
 import tempfile
 import traceback
 try:
     from itertools import izip
 except ImportError:
     izip = zip
-from functools import partial
-from scipy.stats import multivariate_normal
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+from functools import partial, lru_cache
 
 import torch
 import torch.multiprocessing as mp
@@ -28,7 +34,6 @@ from rdkit.Chem import AllChem, Descriptors, QED, Crippen
 from rdkit.Chem.Fingerprints import FingerprintMols
 from SA_Score import sascorer
 from NP_Score import npscorer
-nps_model = npscorer.readNPModel()
 
 import molgrid
 import atom_types
@@ -107,6 +112,7 @@ class AtomFitter(object):
         interm_gd_iters,
         final_gd_iters,
         gd_kwargs,
+        gd_tol,
         dkoes_make_mol,
         use_openbabel,
         output_kernel,
@@ -139,6 +145,9 @@ class AtomFitter(object):
         self.final_gd_iters = final_gd_iters
         self.gd_kwargs = gd_kwargs
 
+        # stop gradient descent early once relative loss change is below this
+        self.gd_tol = gd_tol
+
         # alternate bond adding methods
         self.dkoes_make_mol = dkoes_make_mol
         self.mtr22_make_mol = False
@@ -150,7 +159,27 @@ class AtomFitter(object):
 
         self.grid_maker = molgrid.GridMaker()
         self.c2grid = molgrid.Coords2Grid(self.grid_maker)
+        self.grid_maker_grid = None
         self.kernel = None
+        self.kernel_norm2 = None
+        self.kernel_sum = None
+        self.kernel_fft = None
+        self.kernel_fft_shape = None
+        self.radii_channels = None
+        self.radii = None
+
+    def get_radii(self, channels):
+        '''
+        Return a tensor of the atomic radius of each
+        channel, reusing it while channels are unchanged.
+        '''
+        if channels != self.radii_channels:
+            self.radii = torch.tensor(
+                [ch.atomic_radius for ch in channels],
+                device=self.device,
+            )
+            self.radii_channels = list(channels)
+        return self.radii
 
     def init_kernel(self, channels, resolution, deconv=False):
         '''
@@ -163,10 +192,7 @@ class AtomFitter(object):
         # struct with one atom of each type at the center
         xyz = torch.zeros((n_channels, 3), device=self.device)
         c = torch.eye(n_channels, device=self.device) # one-hot vector types
-        r = torch.tensor(
-            [ch.atomic_radius for ch in channels], 
-            device=self.device
-        )
+        r = self.get_radii(channels)
         self.grid_maker.set_radii_type_indexed(True)
         self.grid_maker.set_resolution(resolution)
 
@@ -181,14 +207,11 @@ class AtomFitter(object):
             )
 
         self.c2grid.center = (0.,0.,0.)
+        self.grid_maker_grid = None # no longer set up for a grid
         values = self.c2grid(xyz, c, r)
 
         if deconv:
-            values = torch.tensor(
-                weiner_invert_kernel(values.cpu(), noise_ratio=1),
-                dtype=values.dtype,
-                device=self.device,
-            )
+            values = weiner_invert_kernel(values, noise_ratio=1)
 
         self.kernel = AtomGrid(
             values=values,
@@ -197,6 +220,12 @@ class AtomFitter(object):
             resolution=resolution,
         )
 
+        # kernel normalizers are fixed, so only compute them once
+        self.kernel_norm2 = (values**2).sum(dim=(1,2,3), keepdim=True)
+        self.kernel_sum = values.sum(dim=(1,2,3))
+        self.kernel_fft = None # computed per grid shape in convolve
+        self.kernel_fft_shape = None
+
         if self.output_kernel:
             dx_prefix = 'deconv_kernel' if deconv else 'conv_kernel'
             if self.verbose:
@@ -211,6 +240,7 @@ class AtomFitter(object):
         '''
         Compute a convolution between the provided
         density grid and the atomic density kernel.
+        Any leading batch dimensions are preserved.
 
         The output is normalized by the kernel norm
         so that values above 0.5 indicate grid points
@@ -219,15 +249,41 @@ class AtomFitter(object):
         if self.kernel is None:
             self.init_kernel(channels, resolution)
 
-        # normalize convolved grid channels by kernel norm
-        kernel_norm2 = (self.kernel.values**2).sum(dim=(1,2,3), keepdim=True)
+        # convolve in frequency domain, zero-padding to the full linear
+        #   convolution size so that nothing wraps around the grid edges
+        kernel_dim = self.kernel.values.shape[-1]
+        grid_shape = tuple(grid.shape[-3:])
+        fft_shape = tuple(d + kernel_dim - 1 for d in grid_shape)
+        fft_dims = (-3, -2, -1)
+
+        # kernel spectrum only depends on the grid shape, so reuse it,
+        #   and fold the kernel norm normalizer into it as well; the
+        #   kernel is flipped so that the product gives a cross-
+        #   correlation like conv3d, since the deconv kernel is not
+        #   symmetric
+        if self.kernel_fft_shape != fft_shape:
+            self.kernel_fft = torch.fft.rfftn(
+                self.kernel.values.flip(dims=fft_dims) / self.kernel_norm2,
+                s=fft_shape,
+                dim=fft_dims,
+            )
+            self.kernel_fft_shape = fft_shape
 
-        return F.conv3d(
-            input=grid.unsqueeze(0),
-            weight=self.kernel.values.unsqueeze(1),
-            padding=self.kernel.values.shape[-1]//2,
-            groups=len(channels),
-        )[0] / kernel_norm2
+        conv = torch.fft.irfftn(
+            torch.fft.rfftn(grid, s=fft_shape, dim=fft_dims) * self.kernel_fft,
+            s=fft_shape,
+            dim=fft_dims,
+        )
+
+        # crop to the input grid, which gives a same-padded
+        #   cross-correlation with the unflipped kernel
+        p = kernel_dim//2
+        return conv[
+            ...,
+            p:p+grid_shape[0],
+            p:p+grid_shape[1],
+            p:p+grid_shape[2],
+        ]
 
     def detect_atoms(self, grid, channels, center, resolution, types=None):
         '''
@@ -245,23 +301,26 @@ class AtomFitter(object):
         apply_threshold = self.threshold is not None and self.threshold > -np.inf
         suppress_non_max = self.min_dist is not None and self.min_dist > 0.0
 
-        if apply_peak_value:
-            peak_value = torch.full((n_channels,), self.peak_value, device=self.device)
-
-        if apply_threshold:
-            threshold = torch.full((n_channels,), self.threshold, device=self.device)
-
         # convolve grid with atomic density kernel
         if self.apply_conv:
             grid = self.convolve(grid, channels, resolution)
 
         # reflect grid values above peak value
         if apply_peak_value:
-            peak_value = peak_value.view(n_channels, 1, 1, 1)
-            grid = peak_value - (peak_value - grid).abs()
+            grid = self.peak_value - (self.peak_value - grid).abs()
+
+        # apply threshold to grid values before sorting,
+        #   so that only the remaining points need to be sorted
+        values = grid.flatten()
+        if apply_threshold:
+            idx = torch.nonzero(values > self.threshold, as_tuple=True)[0]
+            values = values[idx]
+        else:
+            idx = torch.arange(len(values), device=values.device)
 
         # sort grid points by value
-        values, idx = torch.sort(grid.flatten(), descending=True)
+        values, sort_idx = torch.sort(values, descending=True)
+        idx = idx[sort_idx]
 
         # convert flattened grid index to channel and spatial index
         idx_z, idx = idx % grid_dim, idx // grid_dim
@@ -270,13 +329,6 @@ class AtomFitter(object):
         idx_c, idx = idx % n_channels, idx // n_channels
         idx_xyz = torch.stack((idx_x, idx_y, idx_z), dim=1)
 
-        # apply threshold to grid values
-        if apply_threshold:
-            above_thresh = values > threshold[idx_c]
-            values = values[above_thresh]
-            idx_xyz = idx_xyz[above_thresh]
-            idx_c = idx_c[above_thresh]
-
         # exclude grid channels with no atoms left
         if self.constrain_types:
             has_atoms_left = types[idx_c] > 0
@@ -298,10 +350,7 @@ class AtomFitter(object):
         # suppress atoms too close to a higher-value atom of same type
         if suppress_non_max and self.n_atoms_detect > 1:
 
-            r = torch.tensor(
-                [ch.atomic_radius for ch in channels],
-                device=self.device,
-            )
+            r = self.get_radii(channels)
             if len(idx_c) < 1000: # use NxN matrices
                 same_type = (idx_c.unsqueeze(1) == idx_c.unsqueeze(0))
                 bond_radius = r[idx_c].unsqueeze(1) + r[idx_c].unsqueeze(0)
@@ -319,21 +368,50 @@ class AtomFitter(object):
                 xyz = xyz[~too_close]
                 idx_c = idx_c[~too_close]
 
-            else: # use a for loop
-                xyz_max = xyz[0].unsqueeze(0)
-                idx_c_max = idx_c[0].unsqueeze(0)
+            else: # filter blocks of candidates against accepted atoms
+                block_size = 256
 
-                for i in range(1, len(idx_c)):
-                    same_type = (idx_c[i] == idx_c_max)
-                    bond_radius = r[idx_c[i]] + r[idx_c_max]
+                # preallocate accepted atoms and track how many are filled
+                xyz_max = torch.empty_like(xyz)
+                idx_c_max = torch.empty_like(idx_c)
+                n_max = 0
+
+                for i in range(0, len(idx_c), block_size):
+                    xyz_b = xyz[i:i+block_size]
+                    idx_c_b = idx_c[i:i+block_size]
+
+                    # check whole block against previously accepted atoms
+                    same_type = (idx_c_b.unsqueeze(1) == idx_c_max[:n_max].unsqueeze(0))
+                    bond_radius = r[idx_c_b].unsqueeze(1) + r[idx_c_max[:n_max]].unsqueeze(0)
+                    min_dist2 = (self.min_dist * bond_radius)**2
+                    dist2 = ((xyz_b.unsqueeze(1) - xyz_max[:n_max].unsqueeze(0))**2).sum(dim=2)
+                    too_close = ((dist2 < min_dist2) & same_type).any(dim=1)
+
+                    # greedily check remaining atoms within the block,
+                    #   in order of decreasing value
+                    same_type = (idx_c_b.unsqueeze(1) == idx_c_b.unsqueeze(0))
+                    bond_radius = r[idx_c_b].unsqueeze(1) + r[idx_c_b].unsqueeze(0)
                     min_dist2 = (self.min_dist * bond_radius)**2
-                    dist2 = ((xyz[i].unsqueeze(0) - xyz_max)**2).sum(dim=1)
-                    if not ((dist2 < min_dist2) & same_type).any():
-                        xyz_max = torch.cat([xyz_max, xyz[i].unsqueeze(0)])
-                        idx_c_max = torch.cat([idx_c_max, idx_c[i].unsqueeze(0)])
+                    dist2 = ((xyz_b.unsqueeze(1) - xyz_b.unsqueeze(0))**2).sum(dim=2)
+                    close_b = ((dist2 < min_dist2) & same_type).cpu().numpy()
+
+                    keep_b = []
+                    for j in np.flatnonzero(~too_close.cpu().numpy()):
+                        if not close_b[j, keep_b].any():
+                            keep_b.append(j)
+
+                    keep_b = torch.as_tensor(keep_b, dtype=torch.long, device=xyz.device)
+                    n_keep = len(keep_b)
+                    xyz_max[n_max:n_max+n_keep] = xyz_b[keep_b]
+                    idx_c_max[n_max:n_max+n_keep] = idx_c_b[keep_b]
+                    n_max += n_keep
+
+                    # later atoms can only be truncated, so stop early
+                    if 0 <= self.n_atoms_detect <= n_max:
+                        break
 
-                xyz = xyz_max
-                idx_c = idx_c_max
+                xyz = xyz_max[:n_max]
+                idx_c = idx_c_max[:n_max]
 
         # limit total number of detected atoms
         if self.n_atoms_detect >= 0:
@@ -354,9 +432,8 @@ class AtomFitter(object):
         if self.kernel is None:
             self.init_kernel(channels, resolution)
 
-        kernel_sum = self.kernel.values.sum(dim=(1,2,3))
         grid_sum = grid.sum(dim=(1,2,3))
-        return grid_sum / kernel_sum
+        return grid_sum / self.kernel_sum
 
     def fit(self, grid, types):
         '''
@@ -364,18 +441,25 @@ class AtomFitter(object):
         '''
         t_start = time.time()
 
-        # get true grid on appropriate device
+        # get true grid on appropriate device, in single precision
+        #   so that float64 inputs don't promote the whole fit
         grid_true = AtomGrid(
-            values=torch.as_tensor(grid.values, device=self.device),
+            values=torch.as_tensor(
+                grid.values, dtype=torch.float32, device=self.device
+            ),
             channels=grid.channels,
-            center=torch.as_tensor(grid.center, device=self.device),
+            center=torch.as_tensor(
+                grid.center, dtype=torch.float32, device=self.device
+            ),
             resolution=grid.resolution,
         )
 
         # get true atom type counts on appropriate device
         types = torch.tensor(types, dtype=torch.float32, device=self.device)
-        print("grid max",grid.values.max())
-        print("grid min",grid.values.min())
+        if self.verbose: # grid extrema are only needed for logging
+            grid_min, grid_max = torch.aminmax(grid_true.values)
+            print("grid max",grid_max.item())
+            print("grid min",grid_min.item())
         if self.estimate_types: # estimate atom type counts from grid density
             types_est = self.get_types_estimate(
                 grid_true.values,
@@ -396,7 +480,7 @@ class AtomFitter(object):
         if self.fit_L1_loss:
             fit_loss = grid_true.values.abs().sum()
         else:
-            fit_loss = (grid_true.values**2).sum() / 2.0
+            fit_loss = squared_norm(grid_true.values) / 2.0
         type_loss = types.abs().sum()
 
         # to constrain types, order structs first by type diff, then by L2 loss
@@ -416,9 +500,21 @@ class AtomFitter(object):
             types,
         )
 
-        # keep track of best structures so far
+        # keep track of best structures so far, along with their
+        #   density diffs only if atoms don't move, for add_atoms
+        keep_diffs = (self.interm_gd_iters == 0)
         struct_id = 0
-        best_structs = [(objective, struct_id, xyz, c, xyz_next, c_next)]
+        best_structs = [
+            (
+                objective,
+                struct_id,
+                xyz,
+                c,
+                xyz_next,
+                c_next,
+                grid_true.values if keep_diffs else None,
+            )
+        ]
         found_new_best_struct = True
 
         # keep track of visited and expanded structures
@@ -433,7 +529,7 @@ class AtomFitter(object):
             found_new_best_struct = False
 
             # try to expand each current best structure
-            for objective, struct_id, xyz, c, xyz_next, c_next in best_structs:
+            for objective, struct_id, xyz, c, xyz_next, c_next, grid_diff_ in best_structs:
 
                 if struct_id in expanded_ids:
                     continue
@@ -446,10 +542,17 @@ class AtomFitter(object):
                     xyz_new = torch.cat([xyz, xyz_next])
                     c_new = torch.cat([c, c_next])
 
-                    # compute diff and loss after gradient descent
-                    xyz_new, grid_pred, grid_diff, fit_loss = self.fit_gd(
-                        grid_true, xyz_new, c_new, self.interm_gd_iters
-                    )
+                    if self.interm_gd_iters > 0:
+
+                        # compute diff and loss after gradient descent
+                        xyz_new, grid_pred, grid_diff, fit_loss = self.fit_gd(
+                            grid_true, xyz_new, c_new, self.interm_gd_iters
+                        )
+
+                    else: # atoms don't move, so only grid the new atoms
+                        grid_diff, fit_loss = self.add_atoms(
+                            grid_true, grid_diff_, xyz_next, c_next
+                        )
 
                     type_diff = types - c_new.sum(dim=0)
                     type_loss = type_diff.abs().sum()
@@ -479,6 +582,7 @@ class AtomFitter(object):
                                 c_new,
                                 xyz_new_next,
                                 c_new_next,
+                                grid_diff if keep_diffs else None,
                             )
                         )
                         found_new_best_struct = True
@@ -498,10 +602,20 @@ class AtomFitter(object):
                         xyz_new = torch.cat([xyz, xyz_next_.unsqueeze(0)])
                         c_new = torch.cat([c, c_next_.unsqueeze(0)])
 
-                        # compute diff and loss after gradient descent
-                        xyz_new, grid_pred, grid_diff, fit_loss = self.fit_gd(
-                            grid_true, xyz_new, c_new, self.interm_gd_iters
-                        )
+                        if self.interm_gd_iters > 0:
+
+                            # compute diff and loss after gradient descent
+                            xyz_new, grid_pred, grid_diff, fit_loss = self.fit_gd(
+                                grid_true, xyz_new, c_new, self.interm_gd_iters
+                            )
+
+                        else: # atoms don't move, so only grid the new atom
+                            grid_diff, fit_loss = self.add_atoms(
+                                grid_true,
+                                grid_diff_,
+                                xyz_next_.unsqueeze(0),
+                                c_next_.unsqueeze(0),
+                            )
 
                         type_diff = types - c_new.sum(dim=0)
                         type_loss = type_diff.abs().sum()
@@ -531,6 +645,7 @@ class AtomFitter(object):
                                     c_new,
                                     xyz_new_next,
                                     c_new_next,
+                                    grid_diff if keep_diffs else None,
                                 )
                             )
                             found_new_best_struct = True
@@ -564,7 +679,7 @@ class AtomFitter(object):
                     found_new_best_struct = False #dkoes: limit molecular size
 
         # done searching for atomic structures
-        best_objective, best_id, xyz_best, c_best, _, _ = best_structs[0]
+        best_objective, best_id, xyz_best, c_best, _, _, _ = best_structs[0]
         type_loss = (types - c_best.sum(dim=0)).abs().sum().item()
 
         # perform final gradient descent
@@ -573,7 +688,7 @@ class AtomFitter(object):
         )
 
         # compute the final L2 and L1 loss
-        L2_loss = (grid_diff**2).sum() / 2
+        L2_loss = squared_norm(grid_diff) / 2
         L1_loss = grid_diff.abs().sum()
 
         if self.constrain_types:
@@ -629,36 +744,75 @@ class AtomFitter(object):
 
         return remove_tensors(grid_pred)
 
+    def init_grid_maker(self, grid):
+        '''
+        Set up the grid maker to produce grids
+        with the same geometry as the given grid.
+        The geometry is fixed for the whole fit, so
+        only set it up again when the grid changes.
+        '''
+        if grid is self.grid_maker_grid:
+            return
+        self.grid_maker.set_radii_type_indexed(True)
+        self.grid_maker.set_dimension(grid.dimension)
+        self.grid_maker.set_resolution(grid.resolution)
+        self.c2grid.center = tuple(grid.center.cpu().numpy().astype(float))
+        self.grid_maker_grid = grid
+
+    def add_atoms(self, grid, grid_diff, xyz, c):
+        '''
+        Compute the density diff and loss after adding atoms
+        to a structure whose density diff is grid_diff,
+        without moving any atoms. Density is additive, so
+        only the added atoms need to be gridded.
+        '''
+        r = self.get_radii(grid.channels)
+        xyz = xyz.detach().to(self.device)
+        c = c.detach().to(self.device)
+
+        self.init_grid_maker(grid)
+        grid_diff = grid_diff - self.c2grid(xyz, c, r)
+        if self.fit_L1_loss:
+            loss = grid_diff.abs().sum()
+        else:
+            loss = squared_norm(grid_diff) / 2.0
+
+        return grid_diff, loss
+
     def fit_gd(self, grid, xyz, c, n_iters):
 
-        r = torch.tensor(
-            [ch.atomic_radius for ch in grid.channels],
-            device=self.device,
-        )
+        r = self.get_radii(grid.channels)
         xyz = xyz.clone().detach().to(self.device)
         c = c.clone().detach().to(self.device)
         xyz.requires_grad = True
 
         solver = torch.optim.Adam((xyz,), **self.gd_kwargs)
 
-        self.grid_maker.set_radii_type_indexed(True)
-        self.grid_maker.set_dimension(grid.dimension)
-        self.grid_maker.set_resolution(grid.resolution)
-        self.c2grid.center = tuple(grid.center.cpu().numpy().astype(float))
+        self.init_grid_maker(grid)
 
+        prev_loss = np.inf
         for i in range(n_iters + 1):
             solver.zero_grad()
 
-            grid_pred = self.c2grid(xyz, c, r)
-            grid_diff = grid.values - grid_pred
-            if self.fit_L1_loss:
-                loss = grid_diff.abs().sum()
-            else:
-                loss = (grid_diff**2).sum() / 2.0
+            # the final evaluation is never backpropagated,
+            #   so don't record an autograd graph for it
+            with torch.set_grad_enabled(i < n_iters):
+                grid_pred = self.c2grid(xyz, c, r)
+                grid_diff = grid.values - grid_pred
+                if self.fit_L1_loss:
+                    loss = grid_diff.abs().sum()
+                else:
+                    loss = squared_norm(grid_diff) / 2.0
 
-            if i == n_iters: # or converged
+            if i == n_iters:
                 break
 
+            if self.gd_tol > 0: # stop once the relative loss improvement drops below gd_tol
+                curr_loss = loss.item()
+                if abs(prev_loss - curr_loss) <= self.gd_tol*abs(curr_loss):
+                    break
+                prev_loss = curr_loss
+
             loss.backward()
             solver.step()
 
@@ -735,9 +889,10 @@ class AtomFitter(object):
 
 class DkoesAtomFitter(AtomFitter):
 
-    def __init__(self, dkoes_make_mol, use_openbabel, iters=25, tol=0.01):
+    def __init__(self, dkoes_make_mol, use_openbabel, iters=25, tol=0.01, device='cuda'):
         self.iters = iters
         self.tol = tol
+        self.device = device
         self.verbose=False
         self.dkoes_make_mol = dkoes_make_mol
         self.use_openbabel = use_openbabel
@@ -757,6 +912,7 @@ class DkoesAtomFitter(AtomFitter):
                 types=types,
                 iters=self.iters,
                 tol=self.tol,
+                device=self.device,
                 grm=1.0
             )
 
@@ -794,7 +950,8 @@ class OutputWriter(object):
         blob_names,
         fit_atoms,
         batch_metrics,
-        verbose
+        verbose,
+        flush_every=32,
     ):
 
         self.out_prefix = out_prefix
@@ -824,9 +981,21 @@ class OutputWriter(object):
         self.centers = []
 
         self.verbose = verbose
+
+        # rewrite metrics and pymol script every flush_every metric updates,
+        #   which happen once per ligand with batch_metrics, else per sample
+        self.flush_every = flush_every
+        self.n_unflushed = 0
         
         self.out_files = dict() # one file for all samples of given mol/grid
 
+        # write .dx files in background so they overlap with other work
+        self.dx_pool = ThreadPoolExecutor(max_workers=2)
+        self.dx_futures = []
+
+        # scratch buffer for grid differences, reused across metrics
+        self.diff_buf = None
+
     def write(self, lig_name, grid_type, sample_idx, grid):
         '''
         Write output files for grid and compute metrics in
@@ -835,11 +1004,6 @@ class OutputWriter(object):
         grid_prefix = '{}_{}_{}'.format(self.out_prefix, lig_name, grid_type)
 
         sample_prefix = grid_prefix + '_' + str(sample_idx)
-        src_sample_prefix = grid_prefix + '_src_' + str(sample_idx)
-        add_sample_prefix = grid_prefix + '_add_' + str(sample_idx)
-        src_uff_sample_prefix = grid_prefix + '_src_uff_' + str(sample_idx)
-        add_uff_sample_prefix = grid_prefix + '_add_uff_' + str(sample_idx)
-        conv_sample_prefix = grid_prefix + '_conv_' + str(sample_idx)
 
         is_gen_grid = grid_type.endswith('_gen')
         is_fit_grid = grid_type.endswith('_fit')
@@ -854,15 +1018,16 @@ class OutputWriter(object):
             if self.verbose:
                 print('Writing ' + sample_prefix + ' .dx files')
 
-            grid.to_dx(sample_prefix, center=np.zeros(3))
+            self.write_dx(grid, sample_prefix)
             self.dx_prefixes.append(sample_prefix)
 
             if has_conv_grid and self.output_conv:
 
+                conv_sample_prefix = grid_prefix + '_conv_' + str(sample_idx)
                 if self.verbose:
                     print('Writing' + conv_sample_prefix + ' .dx files')
 
-                grid.info['conv_grid'].to_dx(conv_sample_prefix, center=np.zeros(3))
+                self.write_dx(grid.info['conv_grid'], conv_sample_prefix)
                 self.dx_prefixes.append(conv_sample_prefix)
 
         if has_struct and self.output_sdf: # write out structures
@@ -970,21 +1135,10 @@ class OutputWriter(object):
 
                 self.compute_metrics(lig_name, range(self.n_samples))
 
-                if self.verbose:
-                    print('Writing ' + self.metric_file)
-
-                self.metrics.to_csv(self.metric_file, sep=' ')
+                self.n_unflushed += 1
+                if self.n_unflushed >= self.flush_every:
+                    self.flush()
 
-                if self.verbose:
-                    print('Writing ' + self.pymol_file)
-
-                write_pymol_script(
-                    self.pymol_file,
-                    self.out_prefix,
-                    self.dx_prefixes,
-                    self.sdf_files,
-                    self.centers,
-                )
                 del self.grids[lig_name]
 
         else: # only store until grids for this sample are ready
@@ -1001,23 +1155,61 @@ class OutputWriter(object):
 
                 self.compute_metrics(lig_name, [sample_idx])
 
-                if self.verbose:
-                    print('Writing ' + self.metric_file)
+                self.n_unflushed += 1
+                if self.n_unflushed >= self.flush_every:
+                    self.flush()
 
-                self.metrics.to_csv(self.metric_file, sep=' ')
-
-                if self.verbose:
-                    print('Writing ' + self.pymol_file)
-
-                write_pymol_script(
-                    self.pymol_file,
-                    self.out_prefix,
-                    self.dx_prefixes,
-                    self.sdf_files,
-                    self.centers,
-                )
                 del self.grids[lig_name][sample_idx]
 
+    def write_dx(self, grid, dx_prefix):
+        '''
+        Start writing grid to .dx files in a background thread.
+        '''
+        self.dx_futures.append(
+            self.dx_pool.submit(grid.to_dx, dx_prefix, center=np.zeros(3))
+        )
+
+    def wait_dx(self):
+        '''
+        Wait for pending .dx files to be written,
+        raising any error that occurred.
+        '''
+        for future in self.dx_futures:
+            future.result()
+        self.dx_futures = []
+
+    def flush(self):
+        '''
+        Write the metrics computed so far and a pymol
+        script that loads the output files.
+        '''
+        if self.verbose:
+            print('Writing ' + self.metric_file)
+
+        self.metrics.to_csv(self.metric_file, sep=' ')
+
+        if self.verbose:
+            print('Writing ' + self.pymol_file)
+
+        self.wait_dx()
+        write_pymol_script(
+            self.pymol_file,
+            self.out_prefix,
+            self.dx_prefixes,
+            self.sdf_files,
+            self.centers,
+        )
+        self.n_unflushed = 0
+
+    def close(self):
+        '''
+        Finish writing any pending output files.
+        '''
+        if self.n_unflushed > 0:
+            self.flush()
+        self.wait_dx()
+        self.dx_pool.shutdown()
+
     def compute_metrics(self, lig_name, sample_idxs):
         '''
         Compute metrics for density grids, fit atom types, and
@@ -1027,17 +1219,20 @@ class OutputWriter(object):
 
         if self.batch_metrics:
 
-            lig_grid_mean = sum(
-                lig_grids[i]['lig'].values for i in sample_idxs
-            ) / self.n_samples
+            lig_grid_mean = mean_arrays(
+                (lig_grids[i]['lig'].values for i in sample_idxs),
+                self.n_samples,
+            )
 
-            lig_gen_grid_mean = sum(
-                lig_grids[i]['lig_gen'].values for i in sample_idxs
-            ) / self.n_samples
+            lig_gen_grid_mean = mean_arrays(
+                (lig_grids[i]['lig_gen'].values for i in sample_idxs),
+                self.n_samples,
+            )
 
-            lig_latent_mean = sum(
-                lig_grids[i]['lig_gen'].info['latent_vec'] for i in sample_idxs
-            ) / self.n_samples
+            lig_latent_mean = mean_arrays(
+                (lig_grids[i]['lig_gen'].info['latent_vec'] for i in sample_idxs),
+                self.n_samples,
+            )
 
         else:
             lig_grid_mean = None
@@ -1095,9 +1290,8 @@ class OutputWriter(object):
 
             # density variance
             # (divide by n_samples (+1) for sample (population) variance)
-            variance = (
-                (grid.values - mean_grid)**2
-            ).sum().item()
+            diff = self.subtract_grids(grid.values, mean_grid)
+            variance = np.vdot(diff, diff).item()
         else:
             variance = np.nan
 
@@ -1105,16 +1299,29 @@ class OutputWriter(object):
 
         if ref_grid is not None:
 
+            # compute the difference once for both losses
+            diff = self.subtract_grids(ref_grid.values, grid.values)
+
             # density L2 loss
-            m.loc[idx, grid_type+'_L2_loss'] = (
-                (ref_grid.values - grid.values)**2
-            ).sum().item() / 2
+            m.loc[idx, grid_type+'_L2_loss'] = np.vdot(diff, diff).item() / 2
 
             # density L1 loss
             m.loc[idx, grid_type+'_L1_loss'] = (
-                np.abs(ref_grid.values - grid.values)
+                np.abs(diff, out=diff)
             ).sum().item()
 
+    def subtract_grids(self, a, b):
+        '''
+        Return a - b computed into a scratch buffer that is
+        reused by later calls with the same shape and dtype.
+        '''
+        shape = np.broadcast(a, b).shape
+        dtype = np.result_type(a, b)
+        if self.diff_buf is None or self.diff_buf.shape != shape \
+            or self.diff_buf.dtype != dtype:
+            self.diff_buf = np.empty(shape, dtype=dtype)
+        return np.subtract(a, b, out=self.diff_buf)
+
     def compute_latent_metrics(self, idx, latent_type, latent, mean_latent=None):
         m = self.metrics
 
@@ -1124,9 +1331,8 @@ class OutputWriter(object):
         if mean_latent is not None:
 
             # latent vector variance
-            variance = (
-                (latent - mean_latent)**2
-            ).sum()
+            diff = latent - mean_latent
+            variance = np.vdot(diff, diff)
         else:
             variance = np.nan
 
@@ -1199,7 +1405,7 @@ class OutputWriter(object):
         m.loc[idx, mol_type+'_logP'] = get_rd_mol_logP(mol)
         m.loc[idx, mol_type+'_QED'] = get_rd_mol_QED(mol)
         m.loc[idx, mol_type+'_SAS'] = get_rd_mol_SAS(mol)
-        m.loc[idx, mol_type+'_NPS'] = get_rd_mol_NPS(mol, nps_model)
+        m.loc[idx, mol_type+'_NPS'] = get_rd_mol_NPS(mol, get_nps_model())
 
         # convert to SMILES string
         smi = get_smiles_string(mol)
@@ -1267,6 +1473,15 @@ def catch_exc(func, exc=Exception, default=np.nan):
     return wrapper
 
 
+@lru_cache(maxsize=1)
+def get_nps_model():
+    '''
+    Read the natural product-likeness model the first time
+    it's needed, instead of whenever this module is imported.
+    '''
+    return npscorer.readNPModel()
+
+
 get_rd_mol_weight = catch_exc(Chem.Descriptors.MolWt)
 get_rd_mol_logP = catch_exc(Chem.Crippen.MolLogP)
 get_rd_mol_QED = catch_exc(Chem.QED.default)
@@ -1360,33 +1575,34 @@ def get_gpu_usage(gpu_id=0):
 
 def set_rd_mol_aromatic(rd_mol, c, channels):
 
-    # get aromatic carbon channels
-    aroma_c_channels = set()
-    for i, channel in enumerate(channels):
-        if 'AromaticCarbon' in channel.name:
-            aroma_c_channels.add(i)
+    # get aromatic carbon atoms from channel info
+    aroma_c_channels = np.array(
+        ['AromaticCarbon' in channel.name for channel in channels], dtype=bool
+    )
+    aroma_c_atoms = aroma_c_channels[np.asarray(c, dtype=int)]
 
-    # get aromatic carbon atoms
-    aroma_c_atoms = set()
-    for i, c_ in enumerate(c):
-        if c_ in aroma_c_channels:
-            aroma_c_atoms.add(i)
+    # get bond atom indices once as arrays
+    bond_atoms = np.array(
+        [(b.GetBeginAtomIdx(), b.GetEndAtomIdx()) for b in rd_mol.GetBonds()],
+        dtype=int,
+    ).reshape(-1, 2)
 
     # make aromatic rings using channel info
     rings = Chem.GetSymmSSSR(rd_mol)
     for ring_atoms in rings:
-        ring_atoms = set(ring_atoms)
-        if len(ring_atoms & aroma_c_atoms) == 0: #TODO test < 3 instead, and handle heteroatoms
+        ring_atoms = list(ring_atoms)
+        if not aroma_c_atoms[ring_atoms].any(): #TODO test < 3 instead, and handle heteroatoms
             continue
         if (len(ring_atoms) - 2)%4 != 0:
             continue
-        for bond in rd_mol.GetBonds():
-            atom1 = bond.GetBeginAtom()
-            atom2 = bond.GetEndAtom()
-            if atom1.GetIdx() in ring_atoms and atom2.GetIdx() in ring_atoms:
-                atom1.SetIsAromatic(True)
-                atom2.SetIsAromatic(True)
-                bond.SetBondType(Chem.BondType.AROMATIC)
+        in_ring = np.zeros(rd_mol.GetNumAtoms(), dtype=bool)
+        in_ring[ring_atoms] = True
+        ring_bonds = in_ring[bond_atoms[:,0]] & in_ring[bond_atoms[:,1]]
+        for bond_idx in np.flatnonzero(ring_bonds):
+            bond = rd_mol.GetBondWithIdx(int(bond_idx))
+            bond.GetBeginAtom().SetIsAromatic(True)
+            bond.GetEndAtom().SetIsAromatic(True)
+            bond.SetBondType(Chem.BondType.AROMATIC)
 
 
 def connect_rd_mol_frags(rd_mol):
@@ -1396,33 +1612,42 @@ def connect_rd_mol_frags(rd_mol):
     n_frags = len(frags)
     if n_frags > 1:
 
-        nax = np.newaxis
+        # only consider bonds shorter than 5A, so find
+        #   candidate atom pairs with a spatial index
         xyz = rd_mol.GetConformer(0).GetPositions()
-        dist2 = ((xyz[nax,:,:] - xyz[:,nax,:])**2).sum(axis=2)
+        pairs = sp.spatial.cKDTree(xyz).query_pairs(r=5.0, output_type='ndarray')
+        pair_dist2 = ((xyz[pairs[:,0]] - xyz[pairs[:,1]])**2).sum(axis=1)
+        pairs, pair_dist2 = pairs[pair_dist2 < 25], pair_dist2[pair_dist2 < 25]
 
+        # valences change only through the bonds added below,
+        #   so compute them once and update them incrementally
         pt = Chem.GetPeriodicTable()
-        while n_frags > 1:
+        atoms = list(rd_mol.GetAtoms())
+        n_bonds = np.array([
+            sum(b.GetBondTypeAsDouble() for b in a.GetBonds()) for a in atoms
+        ])
+        max_bonds = np.array([
+            pt.GetDefaultValence(a.GetAtomicNum()) for a in atoms
+        ])
+        frag_idx = np.zeros(len(atoms), dtype=int)
 
-            frag_map = {ai: fi for fi, f in enumerate(frags) for ai in f}
-            frag_idx = np.array([frag_map[i] for i in range(rd_mol.GetNumAtoms())])
-            diff_frags = frag_idx[nax,:] != frag_idx[:,nax]
+        while n_frags > 1:
 
-            can_bond = []
-            for a in rd_mol.GetAtoms():
-                n_bonds = sum(b.GetBondTypeAsDouble() for b in a.GetBonds())
-                max_bonds = pt.GetDefaultValence(a.GetAtomicNum())
-                can_bond.append(n_bonds < max_bonds)
+            for fi, f in enumerate(frags):
+                frag_idx[list(f)] = fi
+            diff_frags = frag_idx[pairs[:,0]] != frag_idx[pairs[:,1]]
 
-            can_bond = np.array(can_bond)
-            can_bond = can_bond[nax,:] & can_bond[:,nax]
+            can_bond = n_bonds < max_bonds
+            can_bond = can_bond[pairs[:,0]] & can_bond[pairs[:,1]]
 
-            cond_dist2 = np.where(diff_frags & can_bond & (dist2<25), dist2, np.inf)
+            cond_dist2 = np.where(diff_frags & can_bond, pair_dist2, np.inf)
 
             if not np.any(np.isfinite(cond_dist2)):
                 break # no possible bond meets the conditions
 
-            a1, a2 = np.unravel_index(cond_dist2.argmin(), dist2.shape)
+            a1, a2 = pairs[cond_dist2.argmin()]
             rd_mol.AddBond(int(a1), int(a2), Chem.BondType.SINGLE)
+            n_bonds[[a1, a2]] += 1
             try:
                 rd_mol.UpdatePropertyCache() # update explicit valences
             except:
@@ -1432,30 +1657,43 @@ def connect_rd_mol_frags(rd_mol):
             n_frags = len(frags)
                   
 
+@lru_cache(maxsize=16)
+def read_rd_mols_from_sdf_file_cached(sdf_file):
+    '''
+    Read the molecules in an sdf file as a tuple, caching the
+    result since every sample of a ligand reads the same file.
+    '''
+    return tuple(molecules.read_rd_mols_from_sdf_file(sdf_file))
+
+
 def find_real_mol_in_data_root(data_root, lig_src_no_ext):
     '''
     Try to find the real molecule in data_root using the
     source path found in the data file, without extension.
+    Returns a new copy of the molecule on each call.
     '''
     try: # docked PDBbind ligands are gzipped together
         m = re.match(r'(.+)_ligand_(\d+)', lig_src_no_ext)
         lig_mol_base = m.group(1) + '_docked.sdf.gz'
         idx = int(m.group(2))
         lig_mol_file = os.path.join(data_root, lig_mol_base)
-        lig_mol = molecules.read_rd_mols_from_sdf_file(lig_mol_file)[idx]
+        lig_mol = read_rd_mols_from_sdf_file_cached(lig_mol_file)[idx]
 
     except AttributeError:
 
         try: # cross-docked set has extra underscore
             lig_mol_base = lig_src_no_ext + '_.sdf'
             lig_mol_file = os.path.join(data_root, lig_mol_base)
-            lig_mol = molecules.read_rd_mols_from_sdf_file(lig_mol_file)[0]
+            lig_mol = read_rd_mols_from_sdf_file_cached(lig_mol_file)[0]
 
         except OSError:
             lig_mol_base = lig_src_no_ext + '.sdf'
             lig_mol_file = os.path.join(data_root, lig_mol_base)
-            lig_mol = molecules.read_rd_mols_from_sdf_file(lig_mol_file)[0]
+            lig_mol = read_rd_mols_from_sdf_file_cached(lig_mol_file)[0]
 
+    # samples minimize and annotate their mol, so don't share it
+    if lig_mol is not None:
+        lig_mol = Chem.Mol(lig_mol)
     return lig_mol
 
 
@@ -1463,8 +1701,82 @@ def write_latent_vecs_to_file(latent_file, latent_vecs):
 
     with open(latent_file, 'w') as f:
         for v in latent_vecs:
-            line = ' '.join('{:.5f}'.format(x) for x in v) + '\n'
-            f.write(line)
+            v = np.asarray(v).ravel().tolist()
+            line_fmt = ' '.join(['{:.5f}'] * len(v)) + '\n'
+            f.write(line_fmt.format(*v))
+
+
+def get_atom_density(atom_pos, atom_radius, points, radius_multiple):
+    '''
+    Compute the density value of an atom at a set of points.
+    '''
+    xyz = np.reshape(atom_pos, (1, -1))
+    return get_atoms_density(xyz, atom_radius, points, radius_multiple)[:,0]
+
+
+def get_float_dtype(x):
+    '''
+    Return the dtype of x if it is floating point, otherwise float64.
+    '''
+    dtype = np.asarray(x).dtype
+    if np.issubdtype(dtype, np.floating):
+        return dtype
+    return np.dtype(np.float64)
+
+
+def get_atoms_density(xyz, atom_radius, points, radius_multiple):
+    '''
+    Compute the density value of each atom in xyz at a set of points,
+    returning an array with shape (n_points, n_atoms). The atom_radius
+    can be a scalar or an array of per-atom radii. The computation is
+    done in the floating point precision of points.
+    '''
+    points = np.asarray(points)
+    dtype = get_float_dtype(points)
+    xyz = np.asarray(xyz, dtype=dtype).reshape(-1, points.shape[1])
+    r = np.broadcast_to(np.asarray(atom_radius, dtype=dtype), (len(xyz),))
+    diff = points[:,np.newaxis,:] - xyz[np.newaxis,:,:]
+    dist2 = np.einsum('ijk,ijk->ij', diff, diff)
+    return get_radial_density(dist2, r, radius_multiple)
+
+
+def get_radial_density(dist2, atom_radius, radius_multiple):
+    '''
+    Compute atom density from squared distances to the atom
+    center. The atom_radius must broadcast against dist2.
+    Floating point dist2 keeps its precision (e.g. float32).
+    '''
+    dist2 = np.asarray(dist2)
+    dtype = get_float_dtype(dist2)
+    dist2, r = np.broadcast_arrays(dist2, np.asarray(atom_radius, dtype=dtype))
+    ie2 = np.exp(dtype.type(-2))
+
+    # most points are outside the support of every atom, so
+    #   only evaluate the gaussian and quadratic where needed
+    density = np.zeros(dist2.shape, dtype=dtype)
+
+    # both pieces and the cutoff only depend on (d/r)^2, so compute
+    #   that ratio once and select each piece with a mask on it
+    x = np.multiply(r, r, dtype=dtype)
+    np.divide(dist2, x, out=x)
+    support = x < radius_multiple**2
+    gauss_cond = support & (x <= 1)
+    quad_cond = support & ~gauss_cond
+
+    # with h = r/2, exp(-d^2/(2h^2)) = exp(-2 d^2/r^2),
+    #   computed in place on the gathered values
+    g = x[gauss_cond]
+    g *= -2
+    density[gauss_cond] = np.exp(g, out=g)
+
+    # and e^-2 (d^2/h^2 - 6d/h + 9) = e^-2 (2d/r - 3)^2
+    q = np.sqrt(x[quad_cond])
+    q *= 2
+    q -= 3
+    q *= q
+    q *= ie2
+    density[quad_cond] = q
+    return density
 
 
 def conv_grid(grid, kernel):
@@ -1475,6 +1787,11 @@ def conv_grid(grid, kernel):
 
 
 def weiner_invert_kernel(kernel, noise_ratio=0.0):
+    if isinstance(kernel, torch.Tensor): # stay on the kernel's device
+        F_h = torch.fft.fftn(kernel)
+        F_g = F_h.conj() / (F_h.real**2 + F_h.imag**2 + noise_ratio)
+        return torch.fft.ifftn(F_g).real.to(kernel.dtype)
+
     F_h = np.fft.fftn(kernel)
     conj_F_h = np.conj(F_h)
     F_g = conj_F_h / (F_h*conj_F_h + noise_ratio)
@@ -1485,36 +1802,89 @@ def wiener_deconv_grid(grid, kernel, noise_ratio=0.0):
     '''
     Applies a convolution to the input grid that approximates the inverse
     of the operation that converts a set of atom positions to a grid of
-    atom density.
+    atom density. Operates on the last three axes, so grid and kernel
+    can also be stacks of channel grids and kernels.
     '''
     # we want a convolution g such that g * grid = a, where a is the atom positions
     # we assume that grid = h * a, so g is the inverse of h: g * (h * a) = a
     # take F() to be the Fourier transform, F-1() the inverse Fourier transform
     # convolution theorem: g * grid = F-1(F(g)F(grid))
     # Wiener deconvolution: F(g) = 1/F(h) |F(h)|^2 / (|F(h)|^2 + noise_ratio)
-    F_h = np.fft.fftn(kernel)
-    F_grid = np.fft.fftn(grid)
-    conj_F_h = np.conj(F_h)
-    F_g = conj_F_h / (F_h*conj_F_h + noise_ratio)
-    return np.real(np.fft.ifftn(F_grid * F_g))
+    # the inputs are real, so only half of the spectrum is needed
+    axes = (-3, -2, -1)
+    shape = grid.shape[-3:]
+    F_g = wiener_filter(kernel, noise_ratio)
+    F_grid = sp.fft.rfftn(grid, axes=axes)
+    return sp.fft.irfftn(F_grid * F_g, s=shape, axes=axes)
 
 
-def wiener_deconv_grids(grids, channels, resolution, radius_multiple, noise_ratio=0.0, radius_factor=1.0):
-
-    deconv_grids = np.zeros_like(grids)
-    points = get_grid_points(grids.shape[1:], 0, resolution)
+def wiener_filter(kernel, noise_ratio=0.0):
+    '''
+    Return the half spectrum of the Wiener deconvolution filter
+    for a real kernel, over its last three axes.
+    '''
+    F_h = sp.fft.rfftn(kernel, axes=(-3, -2, -1))
+    return np.conj(F_h) / (F_h.real**2 + F_h.imag**2 + noise_ratio)
 
-    for i, grid in enumerate(grids):
 
-        r = channels[i].atomic_radius*radius_factor
-        kernel = get_atom_density(resolution/2, r, points, radius_multiple).reshape(grid.shape)
-        kernel = np.roll(kernel, shift=[d//2 for d in grid.shape], axis=range(grid.ndim))
-        deconv_grids[i,...] = wiener_deconv_grid(grid, kernel, noise_ratio)
+@lru_cache(maxsize=4)
+def get_wiener_filters(radii, shape, resolution, radius_multiple, noise_ratio=0.0, radius_factor=1.0, dtype=np.float64):
+    '''
+    Return the half spectra of the Wiener deconvolution filters for
+    each atomic radius in radii, over a grid of the given shape. The
+    filters only depend on the arguments, so they are cached across
+    calls and the returned array is read-only.
+    '''
+    # kernel atoms are centered on the origin voxel, so build
+    #   squared distances from wrapped per-axis offsets instead
+    #   of materializing every grid point and shifting after
+    dtype = np.dtype(dtype)
+    dist2 = dtype.type(0)
+    for i, d in enumerate(shape):
+        ax = (np.fft.fftfreq(d, 1.0/d) * resolution).astype(dtype)
+        ax_shape = [1] * len(shape)
+        ax_shape[i] = d
+        dist2 = dist2 + ax.reshape(ax_shape)**2
+
+    radii = np.array(radii, dtype=dtype)
+    radii = radii.reshape((-1,) + (1,)*len(shape)) * dtype.type(radius_factor)
+    kernels = get_radial_density(dist2, radii, radius_multiple)
+    F_g = wiener_filter(kernels, noise_ratio)
+    F_g.flags.writeable = False
+    return F_g
+
+
+def wiener_deconv_grids(grids, channels, resolution, radius_multiple, noise_ratio=0.0, radius_factor=1.0, n_threads=None):
+    '''
+    Return the Wiener deconvolution of each channel in grids by the
+    atomic density kernel for that channel's radius, using n_threads
+    FFT workers (all CPUs by default).
+    '''
+    # channels with the same radius share a kernel, so only compute
+    #   the filters once per unique radius, and reuse them across calls
+    shape = grids.shape[1:]
+    dtype = get_float_dtype(grids)
+    radii = np.array([channels[i].atomic_radius for i in range(len(grids))], dtype=dtype)
+    radii, radius_idx = np.unique(radii, return_inverse=True)
+    F_g = get_wiener_filters(
+        tuple(radii.tolist()), shape, resolution, radius_multiple,
+        noise_ratio, radius_factor, dtype.str
+    )
 
-    return np.stack(deconv_grids, axis=0)
+    # transform all channels in one batched call, letting scipy
+    #   split the work across n_threads workers (all CPUs by default),
+    #   and let the inverse reuse the filtered spectrum's memory
+    axes = (-3, -2, -1)
+    workers = n_threads or -1
+    F_grids = sp.fft.rfftn(grids, axes=axes, workers=workers)
+    F_grids *= F_g[radius_idx]
+    deconv_grids = sp.fft.irfftn(
+        F_grids, s=shape, axes=axes, workers=workers, overwrite_x=True
+    )
+    return deconv_grids.astype(grids.dtype, copy=False)
 
 
-def get_grid_points(shape, center, resolution):
+def get_grid_points(shape, center, resolution, dtype=np.float64):
     '''
     Return an array of points for a grid with
     the given shape, center, and resolution.
@@ -1523,8 +1893,10 @@ def get_grid_points(shape, center, resolution):
     center = np.array(center)
     resolution = np.array(resolution)
     origin = center - resolution*(shape - 1)/2.0
-    indices = np.array(list(np.ndindex(*shape)))
-    return origin + resolution*indices
+    indices = np.stack(
+        np.meshgrid(*[np.arange(d) for d in shape], indexing='ij'), axis=-1
+    ).reshape(-1, len(shape))
+    return (origin + resolution*indices).astype(dtype, copy=False)
 
 
 def grid_to_points_and_values(grid, center, resolution):
@@ -1532,7 +1904,9 @@ def grid_to_points_and_values(grid, center, resolution):
     Convert a grid with a center and resolution to lists
     of grid points and values at each point.
     '''
-    points = get_grid_points(grid.shape, center, resolution)
+    points = get_grid_points(
+        grid.shape, center, resolution, get_float_dtype(grid)
+    )
     return points, grid.flatten()
 
 
@@ -1597,10 +1971,9 @@ def write_pymol_script(pymol_file, out_prefix, dx_prefixes, sdf_files, centers=[
 
 
 def make_one_hot(x, n, dtype=None, device=None):
+    x = torch.as_tensor(x, device=device).long()
     y = torch.zeros(x.shape + (n,), dtype=dtype, device=device)
-    for idx, last_idx in np.ndenumerate(x):
-        y[idx + (int(last_idx),)] = 1
-    return y
+    return y.scatter_(-1, x.unsqueeze(-1), 1)
 
 
 def one_hot_to_index(x):
@@ -1612,9 +1985,7 @@ def one_hot_to_index(x):
 
 def write_channels_to_file(channels_file, c, channels):
     with open(channels_file, 'w') as f:
-        for c_ in c:
-            channel = channels[c_]
-            f.write(channel.name+'\n')
+        f.write(''.join(channels[c_].name+'\n' for c_ in c))
 
 
 def read_channels_from_file(channels_file, channels):
@@ -1648,23 +2019,25 @@ def get_sdf_file_and_idx(gninatypes_file):
     return sdf_file, idx
         
 
-def write_examples_to_data_file(data_file, examples):
+def write_examples_to_data_file(data_file, examples, n_repeats=1):
     '''
-    Write (rec_file, lig_file) examples to data_file.
+    Write (rec_file, lig_file) examples to data_file,
+    with each example repeated n_repeats times in a row.
     '''
     with open(data_file, 'w') as f:
         for rec_file, lig_file in examples:
-            f.write('0 0 {} {}\n'.format(rec_file, lig_file))
+            f.write('0 0 {} {}\n'.format(rec_file, lig_file) * n_repeats)
     return data_file
 
 
-def get_temp_data_file(examples):
+def get_temp_data_file(examples, n_repeats=1):
     '''
     Write (rec_file, lig_file) examples to a temporary
     data file and return the path to the file.
     '''
-    _, data_file = tempfile.mkstemp()
-    write_examples_to_data_file(data_file, examples)
+    fd, data_file = tempfile.mkstemp()
+    os.close(fd) # reopened by name for writing
+    write_examples_to_data_file(data_file, examples, n_repeats)
     return data_file
 
 
@@ -1693,11 +2066,36 @@ def find_blobs_in_net(net, blob_pattern):
     return re.findall('^{}$'.format(blob_pattern), '\n'.join(net.blobs), re.MULTILINE)
 
 
+def mean_arrays(arrays, n):
+    '''
+    Return the sum of an iterable of equal-shape arrays divided by n,
+    accumulating into a single buffer instead of a temporary per term.
+    '''
+    total = None
+    for a in arrays:
+        if total is None:
+            total = np.array(a, dtype=np.result_type(a, np.float32))
+        else:
+            total += a
+    total /= n
+    return total
+
+
+def squared_norm(x):
+    '''
+    Return the sum of squares of a tensor as a single
+    dot product, without a squared temporary.
+    '''
+    x = x.reshape(-1)
+    return torch.dot(x, x)
+
+
 def count_types(c, n_types, dtype=None):
-    count = np.zeros(n_types, dtype=dtype)
-    for i in c:
-        count[i] += 1
-    return count
+    c = np.asarray(c, dtype=int).ravel()
+    count = np.bincount(c, minlength=n_types)
+    if len(count) > n_types:
+        raise IndexError('type index out of range for {} types'.format(n_types))
+    return count.astype(dtype if dtype is not None else float, copy=False)
 
 
 def get_min_rmsd(xyz1, c1, xyz2, c2):
@@ -1730,11 +2128,16 @@ def get_min_rmsd(xyz1, c1, xyz2, c2):
 
     # find min rmsd by solving linear sum assignment
     # problem on squared dist matrix for each type
+    # (types are sorted, so each type is a contiguous slice)
     ssd = 0.0
     nax = np.newaxis
-    for c in set(c1): 
-        xyz1_c = xyz1[c1 == c]
-        xyz2_c = xyz2[c2 == c]
+    _, starts, counts = np.unique(c1, return_index=True, return_counts=True)
+    for i, n in zip(starts, counts):
+        xyz1_c = xyz1[i:i+n]
+        xyz2_c = xyz2[i:i+n]
+        if n == 1: # only one possible mapping
+            ssd += ((xyz1_c - xyz2_c)**2).sum()
+            continue
         dist2_c = ((xyz1_c[:,nax,:] - xyz2_c[nax,:,:])**2).sum(axis=2)
         idx1, idx2 = sp.optimize.linear_sum_assignment(dist2_c)
         ssd += dist2_c[idx1, idx2].sum()
@@ -1759,6 +2162,53 @@ def slerp(v0, v1, t):
          + s1[:,np.newaxis] * v1[np.newaxis,:]
 
 
+def get_example_batches(ex_provider, batch_size, n_batches, random_translate, random_rotation):
+    '''
+    Yield n_batches batches of examples from ex_provider, each
+    with a random transform applied about its ligand center.
+    '''
+    for i in range(n_batches):
+        examples = ex_provider.next_batch(batch_size)
+        for ex in examples:
+            transform = molgrid.Transform(
+                ex.coord_sets[1].center(),
+                random_translate,
+                random_rotation,
+            )
+            transform.forward(ex, ex)
+        yield examples
+
+
+def prefetch(iterable, n_ahead=1):
+    '''
+    Iterate over iterable while a background thread
+    produces up to n_ahead items in advance.
+    '''
+    items = queue.Queue(maxsize=n_ahead)
+    done = object()
+
+    def producer():
+        try:
+            for item in iterable:
+                items.put((item, None))
+        except Exception as e:
+            items.put((done, e))
+        else:
+            items.put((done, None))
+
+    thread = threading.Thread(target=producer)
+    thread.daemon = True
+    thread.start()
+
+    while True:
+        item, exc = items.get()
+        if item is done:
+            if exc is not None:
+                raise exc
+            return
+        yield item
+
+
 def generate_from_model(gen_net, data_param, n_examples, args):
     '''
     Generate grids from specific blob(s) in gen_net for each
@@ -1789,6 +2239,13 @@ def generate_from_model(gen_net, data_param, n_examples, args):
     grid_dims = grid_maker.grid_dimensions(rec_map.num_types() + lig_map.num_types())
     grid_true = torch.zeros(batch_size, *grid_dims, dtype=torch.float32, device=device)
 
+    # copy gridded batches to the host for caffe through one
+    #   reused page-locked buffer, which transfers faster
+    if args.gpu:
+        grid_host = torch.empty(grid_true.shape, dtype=grid_true.dtype, pin_memory=True)
+    else:
+        grid_host = grid_true
+
     print('Finding important blobs')
     try: # find receptor encoder blobs
         rec_enc_start = find_blobs_in_net(gen_net, 'rec')[0]
@@ -1889,12 +2346,20 @@ def generate_from_model(gen_net, data_param, n_examples, args):
         out_thread.start()
 
         if args.fit_atoms: # fit atoms to grids in separate processes
-            fit_queue = mp.Queue(args.n_fit_workers) # queue for atom fitting
-            fit_procs = mp.Pool(
-                processes=args.n_fit_workers,
-                initializer=fit_worker_main,
-                initargs=(fit_queue, out_queue, args),
-            )
+            # don't oversubscribe cores with workers or their torch threads
+            n_cpus = os.cpu_count() or 1
+            n_fit_workers = min(args.n_fit_workers or n_cpus, n_cpus)
+            n_fit_threads = max(1, n_cpus // n_fit_workers)
+
+            fit_queue = mp.Queue(n_fit_workers) # queue for atom fitting
+            fit_procs = []
+            for i in range(n_fit_workers): # persist for the whole run
+                fit_proc = mp.Process(
+                    target=fit_worker_main,
+                    args=(fit_queue, out_queue, args, n_fit_threads),
+                )
+                fit_proc.start()
+                fit_procs.append(fit_proc)
 
     else: # compute metrics, write output, and fit atoms in single thread
 
@@ -1916,7 +2381,11 @@ def generate_from_model(gen_net, data_param, n_examples, args):
         if args.fit_atoms or args.output_conv:
 
             if args.dkoes_simple_fit:
-                atom_fitter = DkoesAtomFitter(args.dkoes_make_mol, args.use_openbabel)
+                atom_fitter = DkoesAtomFitter(
+                    dkoes_make_mol=args.dkoes_make_mol,
+                    use_openbabel=args.use_openbabel,
+                    device=device,
+                )
             else:
                 atom_fitter = AtomFitter(
                     multi_atom=args.multi_atom,
@@ -1937,6 +2406,7 @@ def generate_from_model(gen_net, data_param, n_examples, args):
                         betas=(args.beta1, args.beta2),
                         weight_decay=args.weight_decay,
                     ),
+                    gd_tol=args.gd_tol,
                     dkoes_make_mol=args.dkoes_make_mol,
                     use_openbabel=args.use_openbabel,
                     output_kernel=args.output_kernel,
@@ -1944,6 +2414,17 @@ def generate_from_model(gen_net, data_param, n_examples, args):
                     verbose=args.verbose,
                 )
 
+    # read and transform the next batch of examples in a background
+    #   thread while the current batch is forwarded and fit
+    n_batches = -(-n_examples*args.n_samples // batch_size)
+    example_batches = prefetch(get_example_batches(
+        ex_provider,
+        batch_size,
+        n_batches,
+        args.random_translate,
+        args.random_rotation,
+    ))
+
     # generate density grids from generative model in main thread
     print('Starting to generate grids')
     try:
@@ -1959,23 +2440,19 @@ def generate_from_model(gen_net, data_param, n_examples, args):
 
                 if batch_idx == 0: # forward next batch
 
-                    # get next batch of structures
+                    # get next batch of transformed structures
                     print('Getting batch of examples')
-                    examples = ex_provider.next_batch(batch_size)
+                    examples = next(example_batches)
 
                     # convert structures to grids
-                    print('Transforming and gridding examples')
+                    print('Gridding examples')
                     for i, ex in enumerate(examples):
-                        transform = molgrid.Transform(
-                            ex.coord_sets[1].center(),
-                            args.random_translate,
-                            args.random_rotation,
-                        )
-                        transform.forward(ex, ex)
                         grid_maker.forward(ex, grid_true[i])
 
-                    rec = grid_true[:,:rec_map.num_types(),...].cpu()
-                    lig = grid_true[:,rec_map.num_types():,...].cpu()
+                    if grid_host is not grid_true:
+                        grid_host.copy_(grid_true)
+                    rec = grid_host[:,:rec_map.num_types(),...]
+                    lig = grid_host[:,rec_map.num_types():,...]
 
                     need_first = (args.encode_first or args.condition_first)
                     is_first = (example_idx == sample_idx == 0)
@@ -2008,11 +2485,14 @@ def generate_from_model(gen_net, data_param, n_examples, args):
                         end_rec = np.array(rec[-1:])
                         end_lig = np.array(lig[-1:])
 
+                        # keep the interpolated batch in the grids' float32
                         gen_net.blobs['rec'].data[...] = np.linspace(
-                            start_rec, end_rec, batch_size, endpoint=True
+                            start_rec, end_rec, batch_size, endpoint=True,
+                            dtype=start_rec.dtype,
                         )
                         gen_net.blobs['lig'].data[...] = np.linspace(
-                            start_lig, end_lig, batch_size, endpoint=True
+                            start_lig, end_lig, batch_size, endpoint=True,
+                            dtype=start_lig.dtype,
                         )
 
                     if has_rec_enc: # forward receptor encoder
@@ -2062,6 +2542,11 @@ def generate_from_model(gen_net, data_param, n_examples, args):
                     # decode latent samples to generate grids
                     gen_net.forward(start=lig_dec_start, end=lig_dec_end)
 
+                    # per-blob grid norms and convolutions are computed
+                    #   for the whole batch when the blob is first used
+                    batch_norms = {}
+                    batch_conv_grids = {}
+
                 # get current example ligand
                 if args.interpolate:
                     ex = examples[endpoint_idx]
@@ -2083,13 +2568,10 @@ def generate_from_model(gen_net, data_param, n_examples, args):
 
                     if args.fit_atoms:
                         print('Real molecule for {} has {} atoms'.format(lig_name, lig_struct.n_atoms))
-
-                        print('Minimizing real molecule')
-                        atom_fitter.uff_minimize(lig_mol)
                         lig_struct.info['src_mol'] = lig_mol
 
-                        print('Validifying real atom types and coords')
-                        atom_fitter.validify(lig_struct)
+                        if not args.parallel: # otherwise done in fit workers
+                            prepare_real_struct(atom_fitter, lig_struct)
 
                 # get latent vector for current example
                 latent_vec = np.array(gen_net.blobs[latent_sample].data[batch_idx])
@@ -2122,7 +2604,6 @@ def generate_from_model(gen_net, data_param, n_examples, args):
                         center=lig_struct.center,
                         resolution=grid_maker.get_resolution(),
                     )
-                    grid_norm = np.linalg.norm(grid.values)
 
                     if grid_type == 'lig': # store true structure for input ligand grids
                         grid.info['src_struct'] = lig_struct
@@ -2130,7 +2611,12 @@ def generate_from_model(gen_net, data_param, n_examples, args):
                     elif grid_type == 'lig_gen': # store latent vector for generated grids
                         grid.info['latent_vec'] = latent_vec
 
-                    if args.verbose:
+                    if args.verbose: # grid stats are only needed for logging
+                        if blob_name not in batch_norms:
+                            batch_norms[blob_name] = np.linalg.norm(
+                                grid_blob.data.reshape(grid_blob.shape[0], -1), axis=1
+                            )
+                        grid_norm = batch_norms[blob_name][batch_idx]
                         gpu_usage = get_gpu_usage(0)
 
                         print('Produced {} {} {} (norm={}\tGPU={})'.format(
@@ -2138,18 +2624,21 @@ def generate_from_model(gen_net, data_param, n_examples, args):
                         ), flush=True)
 
                     if args.output_conv:
-                        grid.info['conv_grid'] = grid.new_like(
-                            values=atom_fitter.convolve(
-                                torch.tensor(grid.values, device=atom_fitter.device),
+                        if blob_name not in batch_conv_grids:
+                            batch_conv_grids[blob_name] = atom_fitter.convolve(
+                                torch.tensor(grid_blob.data, device=atom_fitter.device),
                                 grid.channels,
                                 grid.resolution,
                             ).cpu().detach().numpy()
+                        grid.info['conv_grid'] = grid.new_like(
+                            values=batch_conv_grids[blob_name][batch_idx]
                         )
 
                     if args.parallel:
-                        out_queue.put((lig_name, grid_type, sample_idx, grid))
-                        if grid_needs_fit:
+                        if grid_needs_fit: # fit worker outputs grid and fit grid
                             fit_queue.put((lig_name, grid_type, sample_idx, grid, types))
+                        else:
+                            out_queue.put((lig_name, grid_type, sample_idx, grid))
                     else:
                         out_writer.write(lig_name, grid_type, sample_idx, grid)
                         if grid_needs_fit:
@@ -2159,23 +2648,44 @@ def generate_from_model(gen_net, data_param, n_examples, args):
     finally:
         if args.parallel:
             if args.fit_atoms:
-                #for i in range(args.n_fit_workers):
-                #    fit_queue.put(None)
-                fit_procs.close()
-                fit_procs.join()
+                for fit_proc in fit_procs:
+                    fit_queue.put(None)
+                for fit_proc in fit_procs:
+                    fit_proc.join()
             out_queue.put(None)
             out_thread.join()
 
+    # only flush remaining output on success, so that an error
+    #   while flushing can't hide the original exception
+    if not args.parallel:
+        out_writer.close()
+
     if args.verbose:
         print('Main thread exit')
 
 
-def fit_worker_main(fit_queue, out_queue, args):
+def prepare_real_struct(atom_fitter, lig_struct):
+    '''
+    Minimize the real molecule of a true ligand struct
+    and validify the struct's real atom types and coords.
+    '''
+    print('Minimizing real molecule')
+    atom_fitter.uff_minimize(lig_struct.info['src_mol'])
+
+    print('Validifying real atom types and coords')
+    atom_fitter.validify(lig_struct)
+
+
+def fit_worker_main(fit_queue, out_queue, args, n_threads=None):
+
+    if n_threads is not None:
+        torch.set_num_threads(n_threads)
 
     if args.dkoes_simple_fit:
         atom_fitter = DkoesAtomFitter(
             dkoes_make_mol=args.dkoes_make_mol,
             use_openbabel=args.use_openbabel,
+            device='cpu', # cuda can't be used in forked worker processes
         )
     else:
         atom_fitter = AtomFitter(
@@ -2197,10 +2707,11 @@ def fit_worker_main(fit_queue, out_queue, args):
                 betas=(args.beta1, args.beta2),
                 weight_decay=args.weight_decay,
             ),
+            gd_tol=args.gd_tol,
             dkoes_make_mol=args.dkoes_make_mol,
             use_openbabel=args.use_openbabel,
             output_kernel=args.output_kernel,
-            device='cpu', # can't fit on gpu in multiple threads
+            device='cpu', # cuda can't be used in forked worker processes
             verbose=args.verbose,
         )
 
@@ -2217,14 +2728,18 @@ def fit_worker_main(fit_queue, out_queue, args):
         if args.verbose:
             print('Fit worker got {} {} {}'.format(lig_name, grid_type, sample_idx))
 
+        if grid_type == 'lig': # real molecule work is also per-ligand
+            prepare_real_struct(atom_fitter, grid.info['src_struct'])
+
         out_queue.put((lig_name, grid_type, sample_idx, grid))
 
         grid = atom_fitter.fit(grid, types)
         grid_type = grid_type + '_fit'
+        struct_fit = grid.info['src_struct']
 
         if args.verbose:
             print('Fit worker produced {} {} {} ({} atoms, {}s)'.format(
-                lig_name, grid_type, sample_idx, struct_fit.n_atoms, struct_fit.fit_time
+                lig_name, grid_type, sample_idx, struct_fit.n_atoms, struct_fit.info['time']
             ), flush=True)
 
         out_queue.put((lig_name, grid_type, sample_idx, grid))
@@ -2256,11 +2771,13 @@ def out_worker_main(out_queue, args):
             break
         out_writer.write(*task)
 
+    out_writer.close()
+
     if args.verbose:
         print('Output worker exit')
 
 
-def parse_args(argv=None):
+def make_arg_parser():
     parser = argparse.ArgumentParser(description='Generate atomic density grids from generative model with Caffe')
     parser.add_argument('-d', '--data_model_file', required=True, help='prototxt file for data model')
     parser.add_argument('-g', '--gen_model_file', required=True, help='prototxt file for generative model')
@@ -2278,7 +2795,7 @@ def parse_args(argv=None):
     parser.add_argument('--condition_first', default=False, action='store_true', help='condition all generated output on first example')
     parser.add_argument('--interpolate', default=False, action='store_true', help='interpolate between examples in latent space')
     parser.add_argument('--spherical', default=False, action='store_true', help='use spherical interpolation instead of linear')
-    parser.add_argument('-o', '--out_prefix', required=True, help='common prefix for output files')
+    parser.add_argument('-o', '--out_prefix', required=True, help='common prefix for output files (the .gen_metrics file and .pymol script are rewritten every 32 metric updates, i.e. ligands with --batch_metrics or else samples, and on exit)')
     parser.add_argument('--output_dx', action='store_true', help='output .dx files of atom density grids for each channel')
     parser.add_argument('--output_sdf', action='store_true', help='output .sdf file of best fit atom positions')
     parser.add_argument('--output_conv', action='store_true', help='output .dx files of atom density grids convolved with kernel')
@@ -2302,6 +2819,7 @@ def parse_args(argv=None):
     parser.add_argument('--fit_L1_loss', default=False, action='store_true')
     parser.add_argument('--interm_gd_iters', type=int, default=10, help='number of gradient descent iterations after each step of atom fitting')
     parser.add_argument('--final_gd_iters', type=int, default=100, help='number of gradient descent iterations after final step of atom fitting')
+    parser.add_argument('--gd_tol', type=float, default=0.0, help='stop gradient descent early when relative loss change is below this (0 to disable)')
     parser.add_argument('--learning_rate', type=float, default=0.1, help='learning rate for Adam optimizer')
     parser.add_argument('--beta1', type=float, default=0.9, help='beta1 for Adam optimizer')
     parser.add_argument('--beta2', type=float, default=0.999, help='beta2 for Adam optimizer')
@@ -2319,9 +2837,17 @@ def parse_args(argv=None):
     parser.add_argument('--fix_center_to_origin', default=False, action='store_true', help='fix input grid center to origin')
     parser.add_argument('--use_covalent_radius', default=False, action='store_true', help='force input grid to use covalent radius')
     parser.add_argument('--parallel', default=False, action='store_true', help='run atom fitting in separate worker processes')
-    parser.add_argument('--n_fit_workers', default=8, type=int, help='number of worker processes for parallel atom fitting')
+    parser.add_argument('--n_fit_workers', default=None, type=int, help='number of worker processes for parallel atom fitting (default: one per cpu)')
     parser.add_argument('--gen_only',action='store_true',help='Only produce generated molecules; do not perform fitting on true ligand')
-    return parser.parse_args(argv)
+    return parser
+
+
+# the arguments never change, so only build the parser once
+arg_parser = make_arg_parser()
+
+
+def parse_args(argv=None):
+    return arg_parser.parse_args(argv)
 
 
 def main(argv):
@@ -2339,7 +2865,7 @@ def main(argv):
     pd.set_option('display.width', display_width)
 
     if not args.blob_name:
-        args.blob_name += ['lig', 'lig_gen']
+        args.blob_name = ['lig', 'lig_gen'] # don't extend the shared default
 
     # read the model param files and set atom gridding params
     data_net_param = caffe_util.NetParameter.from_prototxt(args.data_model_file)
@@ -2372,7 +2898,7 @@ def main(argv):
     else: # use the examples in data_file
         examples = read_examples_from_data_file(args.data_file)
 
-    data_file = get_temp_data_file(e for e in examples for i in range(args.n_samples))
+    data_file = get_temp_data_file(examples, n_repeats=args.n_samples)
     data_param.source = data_file
     data_param.root_folder = args.data_root
 
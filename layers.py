@@ -76,7 +76,7 @@ class ChannelEuclideanLossLayer(caffe.Layer):
         self.chan_weight = np.zeros(n_channels, dtype=np.float32)
 
         n_dims = len(input0_shape)
-        self.non_chan_axes = tuple(i for i in range(n_dims) if i != 1)
+        self.all_axes = list(range(n_dims))
         self.chan_shape = tuple(n_channels if i == 1 else 1 for i in range(n_dims))
 
         top[0].reshape(1)
@@ -85,21 +85,30 @@ class ChannelEuclideanLossLayer(caffe.Layer):
 
         # get total squared error in each channel (batch mean)
         batch_size = bottom[0].shape[0]
-        self.diff[...] = bottom[0].data - bottom[1].data
-        self.chan_sse[...] = np.sum(self.diff**2, axis=self.non_chan_axes) / batch_size / 2.0
+        np.subtract(bottom[0].data, bottom[1].data, out=self.diff)
+        self.chan_sse[...] = self.chan_sum_squares(self.diff) / batch_size / 2.0
 
         # weights are inversely proportional to label channel squared L2 norms and have mean of 1.0
-        self.chan_norm[...] = np.sum(bottom[1].data**2, axis=self.non_chan_axes) / batch_size + EPS
+        self.chan_norm[...] = self.chan_sum_squares(bottom[1].data) / batch_size + self.EPS
         self.chan_weight[...] = (1 / np.mean(1 / self.chan_norm)) / self.chan_norm
 
         # weighted sum across channels
         top[0].data[...] = np.sum(self.chan_sse * self.chan_weight)
 
+    def chan_sum_squares(self, x):
+        '''
+        Sum of squares of x in each channel, without
+        materializing x**2 as a temporary.
+        '''
+        return np.einsum(x, self.all_axes, x, self.all_axes, [1])
+
     def backward(self, top, propagate_down, bottom):
 
         batch_size = bottom[0].shape[0]
         if propagate_down[0]:
-            bottom[0].diff[...] = self.diff * np.reshape(self.chan_weight, self.chan_shape) / batch_size
+            # scale each channel in a single pass, straight into the blob diff
+            chan_scale = np.reshape(self.chan_weight / batch_size, self.chan_shape)
+            np.multiply(self.diff, chan_scale, out=bottom[0].diff)
 
 
 class MaskedEuclideanLossLayer(caffe.Layer):
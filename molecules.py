@@ -23,12 +23,9 @@ def make_rd_mol(xyz, c, bonds, channels):
     rd_mol.AddConformer(rd_conf)
 
     if np.any(bonds):
-        n_bonds = 0
-        for i in range(n_atoms):
-            for j in range(i+1, n_atoms):
-                if bonds[i,j]:
-                    rd_mol.AddBond(i, j, Chem.BondType.SINGLE)
-                    n_bonds += 1
+        # bonded atom pairs with j > i, in row-major order
+        for i, j in zip(*np.nonzero(np.triu(bonds, 1))):
+            rd_mol.AddBond(int(i), int(j), Chem.BondType.SINGLE)
 
     return rd_mol
 
@@ -72,15 +69,12 @@ def make_ob_mol(xyz, c, bonds, channels):
         n_atoms += 1
 
     if np.any(bonds):
-        n_bonds = 0
-        for i in range(n_atoms):
-            atom_i = ob_mol.GetAtom(i)
-            for j in range(i+1, n_atoms):
-                atom_j = ob_mol.GetAtom(j)
-                if bonds[i,j]:
-                    bond = ob_mol.NewBond()
-                    bond.Set(n_bonds, atom_i, atom_j, 1, 0)
-                    n_bonds += 1
+        # bonded atom pairs with j > i, in row-major order
+        for n_bonds, (i, j) in enumerate(zip(*np.nonzero(np.triu(bonds, 1)))):
+            atom_i = ob_mol.GetAtom(int(i))
+            atom_j = ob_mol.GetAtom(int(j))
+            bond = ob_mol.NewBond()
+            bond.Set(n_bonds, atom_i, atom_j, 1, 0)
     return ob_mol
 
 
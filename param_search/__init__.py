@@ -3,8 +3,16 @@ from .job_scripts import setup_job_scripts as setup
 from .job_queues import SlurmQueue, TorqueQueue
 from .job_output import get_job_errors as errors
 from .job_output import get_job_metrics as metrics
-from .results import plot
 
 # TODO allow switching to TorqueQueue
 submit = SlurmQueue.submit_job_scripts
 status = SlurmQueue.get_job_status
+
+
+def __getattr__(name):
+    # results pulls in matplotlib and seaborn, so only
+    #   import it when plot is actually used
+    if name == 'plot':
+        from .results import plot
+        return plot
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
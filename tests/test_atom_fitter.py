@@ -0,0 +1,155 @@
+import sys, os
+import numpy as np
+import torch
+ligan_root = os.environ['LIGAN_ROOT']
+sys.path.append(ligan_root)
+import atom_types
+import generate
+
+
+def get_atom_fitter(**kwargs):
+    fitter_kwargs = dict(
+        beam_size=1,
+        multi_atom=False,
+        n_atoms_detect=1,
+        apply_conv=False,
+        threshold=0.1,
+        peak_value=1.5,
+        min_dist=0.0,
+        constrain_types=False,
+        constrain_frags=False,
+        estimate_types=False,
+        fit_L1_loss=False,
+        interm_gd_iters=0,
+        final_gd_iters=0,
+        gd_kwargs=dict(lr=0.1),
+        gd_tol=0.0,
+        dkoes_make_mol=False,
+        use_openbabel=False,
+        output_kernel=False,
+        device='cpu',
+    )
+    fitter_kwargs.update(kwargs)
+    return generate.AtomFitter(**fitter_kwargs)
+
+
+def get_true_grid_and_atoms(fitter):
+    '''
+    Return a small grid rendered from three atoms,
+    along with the atom coords and one-hot types.
+    '''
+    channels = atom_types.get_default_lig_channels()
+    n_channels = len(channels)
+    grid = generate.AtomGrid(
+        values=torch.zeros((n_channels, 25, 25, 25)),
+        channels=channels,
+        center=torch.zeros(3),
+        resolution=0.5,
+    )
+    xyz = torch.tensor([[0.0, 0.0, 0.0], [1.5, 0.0, 0.0], [0.0, 1.4, 0.3]])
+    c = torch.eye(n_channels)[[0, 1, 2]]
+    fitter.init_grid_maker(grid)
+    grid.values = fitter.c2grid(xyz, c, fitter.get_radii(channels)).detach()
+    return grid, xyz, c
+
+
+def test_add_atoms_matches_full_regrid():
+
+    fitter = get_atom_fitter()
+    grid, xyz, c = get_true_grid_and_atoms(fitter)
+
+    # the full re-render path, with atoms offset from the true ones
+    xyz = xyz + torch.tensor([0.3, -0.2, 0.1])
+    for n_parent in [0, 1, 2]:
+        _, _, parent_diff, _ = fitter.fit_gd(grid, xyz[:n_parent], c[:n_parent], 0)
+        _, _, full_diff, full_loss = fitter.fit_gd(grid, xyz, c, 0)
+
+        # only grid the added atoms on top of the parent diff
+        diff, loss = fitter.add_atoms(grid, parent_diff, xyz[n_parent:], c[n_parent:])
+
+        assert torch.allclose(diff, full_diff, atol=1e-5)
+        assert np.isclose(loss.item(), full_loss.item(), rtol=1e-4)
+
+
+def test_add_atoms_matches_full_regrid_L1():
+
+    fitter = get_atom_fitter(fit_L1_loss=True)
+    grid, xyz, c = get_true_grid_and_atoms(fitter)
+
+    xyz = xyz + torch.tensor([0.3, -0.2, 0.1])
+    _, _, parent_diff, _ = fitter.fit_gd(grid, xyz[:2], c[:2], 0)
+    _, _, full_diff, full_loss = fitter.fit_gd(grid, xyz, c, 0)
+    diff, loss = fitter.add_atoms(grid, parent_diff, xyz[2:], c[2:])
+
+    assert torch.allclose(diff, full_diff, atol=1e-5)
+    assert np.isclose(loss.item(), full_loss.item(), rtol=1e-4)
+
+
+class CountCalls(object):
+    '''
+    Wrap a Coords2Grid and count how many grids it makes.
+    '''
+    def __init__(self, c2grid):
+        self.__dict__['c2grid'] = c2grid
+        self.__dict__['n_calls'] = 0
+
+    def __call__(self, *args):
+        self.__dict__['n_calls'] += 1
+        return self.c2grid(*args)
+
+    def __getattr__(self, name):
+        return getattr(self.c2grid, name)
+
+    def __setattr__(self, name, value):
+        setattr(self.c2grid, name, value)
+
+
+def fit_gd_reference(fitter, grid, xyz, c, n_iters):
+    '''
+    Adam fit of atom coords without any early stopping.
+    '''
+    r = fitter.get_radii(grid.channels)
+    xyz = xyz.clone().detach().requires_grad_(True)
+    solver = torch.optim.Adam((xyz,), **fitter.gd_kwargs)
+    fitter.init_grid_maker(grid)
+    for i in range(n_iters):
+        solver.zero_grad()
+        grid_diff = grid.values - fitter.c2grid(xyz, c, r)
+        loss = (grid_diff**2).sum() / 2.0
+        loss.backward()
+        solver.step()
+    grid_diff = grid.values - fitter.c2grid(xyz, c, r)
+    loss = (grid_diff**2).sum() / 2.0
+    return xyz.detach(), loss.detach()
+
+
+def test_fit_gd_zero_tol_runs_all_iters():
+
+    n_iters = 20
+    fitter = get_atom_fitter(gd_tol=0.0)
+    grid, xyz, c = get_true_grid_and_atoms(fitter)
+    xyz_init = xyz + torch.tensor([0.3, -0.2, 0.1])
+
+    xyz_ref, loss_ref = fit_gd_reference(fitter, grid, xyz_init, c, n_iters)
+
+    fitter.c2grid = CountCalls(fitter.c2grid)
+    xyz_fit, _, _, loss = fitter.fit_gd(grid, xyz_init, c, n_iters)
+
+    assert fitter.c2grid.n_calls == n_iters + 1
+    assert torch.allclose(xyz_fit, xyz_ref, atol=1e-5)
+    assert np.isclose(loss.item(), loss_ref.item(), rtol=1e-4)
+
+
+def test_fit_gd_positive_tol_stops_early():
+
+    n_iters = 200
+    fitter = get_atom_fitter(gd_tol=1e-2)
+    grid, xyz, c = get_true_grid_and_atoms(fitter)
+    xyz_init = xyz + torch.tensor([0.3, -0.2, 0.1])
+    _, _, _, init_loss = fitter.fit_gd(grid, xyz_init, c, 0)
+
+    fitter.c2grid = CountCalls(fitter.c2grid)
+    _, _, _, loss = fitter.fit_gd(grid, xyz_init, c, n_iters)
+
+    assert fitter.c2grid.n_calls < n_iters + 1
+    assert loss.item() < init_loss.item()
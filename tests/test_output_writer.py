@@ -0,0 +1,78 @@
+import sys, os
+import numpy as np
+import pandas as pd
+ligan_root = os.environ['LIGAN_ROOT']
+sys.path.append(ligan_root)
+import atom_types
+import generate
+
+
+def get_output_writer(out_prefix, flush_every):
+    return generate.OutputWriter(
+        out_prefix=out_prefix,
+        output_dx=False,
+        output_sdf=False,
+        output_channels=False,
+        output_latent=False,
+        output_visited=False,
+        output_conv=False,
+        n_samples=1,
+        blob_names=['lig', 'lig_gen'],
+        fit_atoms=False,
+        batch_metrics=False,
+        verbose=False,
+        flush_every=flush_every,
+    )
+
+
+def get_grid(**info):
+    channels = atom_types.get_default_lig_channels()
+    values = np.random.rand(len(channels), 8, 8, 8).astype(np.float32)
+    return generate.AtomGrid(
+        values=values,
+        channels=channels,
+        center=np.zeros(3),
+        resolution=0.5,
+        **info
+    )
+
+
+def write_lig(writer, lig_name):
+    writer.write(lig_name, 'lig', 0, get_grid())
+    writer.write(lig_name, 'lig_gen', 0, get_grid(latent_vec=np.random.randn(8)))
+
+
+def read_metrics(metric_file):
+    return pd.read_csv(metric_file, sep=' ', index_col=[0, 1])
+
+
+def test_output_writer_flushes_every_n(tmp_path):
+
+    out_prefix = str(tmp_path / 'test')
+    writer = get_output_writer(out_prefix, flush_every=2)
+    write_lig(writer, 'lig0')
+
+    # nothing written until flush_every ligands have metrics
+    assert not os.path.exists(writer.metric_file)
+    assert not os.path.exists(writer.pymol_file)
+
+    write_lig(writer, 'lig1')
+    assert len(read_metrics(writer.metric_file)) == 2
+    assert os.path.exists(writer.pymol_file)
+    writer.close()
+
+
+def test_output_writer_flushes_on_close(tmp_path):
+
+    out_prefix = str(tmp_path / 'test')
+    writer = get_output_writer(out_prefix, flush_every=2)
+    for i in range(3):
+        write_lig(writer, 'lig{}'.format(i))
+
+    # the last ligand is pending until close
+    assert len(read_metrics(writer.metric_file)) == 2
+
+    writer.close()
+    metrics = read_metrics(writer.metric_file)
+    assert len(metrics) == 3
+    assert list(metrics.index.get_level_values(0)) == ['lig0', 'lig1', 'lig2']
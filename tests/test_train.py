@@ -0,0 +1,18 @@
+import sys, os
+import numpy as np
+ligan_root = os.environ['LIGAN_ROOT']
+sys.path.append(ligan_root)
+import train
+
+
+def test_add_instance_noise_float32():
+
+    rng = np.random.default_rng(0)
+    x = np.ones((4, 19, 12, 12, 12), dtype=np.float32)
+    noise_buf = np.empty_like(x)
+
+    train.add_instance_noise(x, 0.5, rng, noise_buf)
+
+    assert x.shape == (4, 19, 12, 12, 12)
+    assert x.dtype == np.float32
+    assert np.isclose((x - 1).std(), 0.5, rtol=1e-2)
@@ -35,7 +35,10 @@ def get_gradient_norm(net, ord=2):
     grad_norm = 0.0
     for blob_vec in net.params.values():
         for blob in blob_vec:
-            grad_norm += (abs(blob.diff)**ord).sum()
+            if ord == 2: # sum of squares without a temporary array
+                grad_norm += np.vdot(blob.diff, blob.diff)
+            else:
+                grad_norm += (abs(blob.diff)**ord).sum()
     return grad_norm**(1/ord)
 
 
@@ -69,7 +72,7 @@ def spectral_power_iterate(W, u, n_iter):
         v = normalize(np.matmul(W.T, u))
         u = normalize(np.matmul(W, v))
 
-    sigma = np.matmul(u.T, np.matmul(W, v))
+    sigma = np.dot(u, np.matmul(W, v))
     return u, v, sigma
 
 
@@ -112,12 +115,22 @@ def spectral_norm_backward(net, params):
         W = net.params[layer][0]
         y = net.blobs[layer]
         u, v, sigma = params[layer]
-        lambda_ = np.sum(y.diff * y.data) / y.shape[0]
-        W.diff[...] -= (lambda_ * np.outer(u, v)).reshape(W.shape)
+        lambda_ = np.vdot(y.diff, y.data) / y.shape[0]
+        W.diff[...] -= np.outer(u, lambda_*v).reshape(W.shape)
         W.diff[...] /= sigma
 
 
-def disc_step(data, gen, disc, n_iter, args, train, compute_metrics):
+def add_instance_noise(x, std, rng, noise_buf):
+    '''
+    Add normally distributed noise with standard deviation std
+    to the array x in place, drawing it from rng into noise_buf.
+    '''
+    rng.standard_normal(out=noise_buf, dtype=noise_buf.dtype)
+    noise_buf *= std
+    x += noise_buf
+
+
+def disc_step(data, gen, disc, n_iter, args, train, compute_metrics, noise_rng=None, noise_buf=None):
     '''
     Train or test GAN discriminator for n_iter iterations.
     '''
@@ -174,8 +187,9 @@ def disc_step(data, gen, disc, n_iter, args, train, compute_metrics):
             disc.net.blobs['label'].set_data(0.0)
 
         if args.instance_noise:
-            noise = np.random.normal(0, args.instance_noise, lig.shape)
-            disc.net.blobs['lig'].data[...] += noise
+            add_instance_noise(
+                disc.net.blobs['lig'].data, args.instance_noise, noise_rng, noise_buf
+            )
 
         if args.disc_spectral_norm:
             spectral_norm_forward(disc.net, args.disc_spectral_norm)
@@ -216,7 +230,7 @@ def disc_step(data, gen, disc, n_iter, args, train, compute_metrics):
     return {m: np.nanmean(metrics[m]) for m in metrics}
 
 
-def gen_step(data, gen, disc, n_iter, args, train, compute_metrics):
+def gen_step(data, gen, disc, n_iter, args, train, compute_metrics, noise_rng=None, noise_buf=None):
     '''
     Train or test the GAN generator for n_iter iterations.
     '''
@@ -296,8 +310,9 @@ def gen_step(data, gen, disc, n_iter, args, train, compute_metrics):
         disc.net.blobs['label'].set_data(1.0)
 
         if args.instance_noise:
-            noise = np.random.normal(0, args.instance_noise, lig.shape)
-            disc.net.blobs['lig'].data[...] += noise
+            add_instance_noise(
+                disc.net.blobs['lig'].data, args.instance_noise, noise_rng, noise_buf
+            )
 
         if args.disc_spectral_norm:
             spectral_norm_forward(disc.net, args.disc_spectral_norm)
@@ -383,7 +398,7 @@ def write_and_plot_metrics(loss_df, loss_file, plot_file):
     plt.close(fig)
 
 
-def train_GAN_model(train_data, test_data, gen, disc, loss_df, loss_file, plot_file, args):
+def train_GAN_model(train_data, test_data, gen, disc, loss_df, loss_file, plot_file, args, noise_rng=None, noise_buf=None):
     '''
     Train a GAN using the provided train_data net, gen solver, and disc solver.
     Return loss_df of metrics evaluated on train and test data, while also writing
@@ -418,10 +433,12 @@ def train_GAN_model(train_data, test_data, gen, disc, loss_df, loss_file, plot_f
             for d in test_data:
 
                 disc_metrics = disc_step(test_data[d], gen, disc, args.test_iter, args,
-                                         train=False, compute_metrics=True)
+                                         train=False, compute_metrics=True,
+                                         noise_rng=noise_rng, noise_buf=noise_buf)
 
                 gen_metrics  = gen_step(test_data[d], gen, disc, args.test_iter, args,
-                                        train=False, compute_metrics=True)
+                                        train=False, compute_metrics=True,
+                                        noise_rng=noise_rng, noise_buf=noise_buf)
 
                 insert_metrics(loss_df, i, d, disc_metrics)
                 insert_metrics(loss_df, i, d, gen_metrics)
@@ -466,13 +483,15 @@ def train_GAN_model(train_data, test_data, gen, disc, loss_df, loss_file, plot_f
         # but still need forward for loss computation
         dstart = time.time()
         disc_metrics = disc_step(train_data, gen, disc, args.disc_train_iter, args,            
-              train=train_disc, compute_metrics=False)
+              train=train_disc, compute_metrics=False,
+              noise_rng=noise_rng, noise_buf=noise_buf)
         dtime += time.time()-dstart
         if train_disc: dcnt += 1
 
         gstart = time.time()
         gen_metrics = gen_step(train_data, gen, disc, args.gen_train_iter, args,
-             train=train_gen, compute_metrics=False)
+             train=train_gen, compute_metrics=False,
+             noise_rng=noise_rng, noise_buf=noise_buf)
         gtime += time.time()-gstart
         if train_gen: gcnt += 1
 
@@ -613,6 +632,9 @@ def main(argv):
     solver_param.test_interval = args.max_iter + 1
     solver_param.random_seed = args.random_seed
     caffe.set_random_seed(args.random_seed) #this should be redundant
+
+    # instance noise is drawn every step, so seed one generator
+    noise_rng = np.random.default_rng(args.random_seed)
     
     #check for cmdline overrides
     if args.solver is not None:
@@ -675,9 +697,16 @@ def main(argv):
 
         plot_file = '{}_{}.png'.format(args.out_prefix, fold)
 
+        # reuse one buffer for the disc ligand instance noise
+        if args.instance_noise:
+            noise_buf = np.empty_like(disc.net.blobs['lig'].data)
+        else:
+            noise_buf = None
+
         # begin training GAN
         try:
-            train_GAN_model(train_data, test_data, gen, disc, loss_df, loss_file, plot_file, args)
+            train_GAN_model(train_data, test_data, gen, disc, loss_df, loss_file, plot_file, args,
+                            noise_rng, noise_buf)
         except:
             raise
             gen.snapshot()